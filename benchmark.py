@@ -0,0 +1,501 @@
+"""
+Benchmarks for ec3 against a local stand-in for the ECCC bulk data endpoint.
+
+Usage:
+  benchmark.py [--json <file>] [<scenario>...]
+  benchmark.py --list
+
+Options:
+  --json <file>        Also save the results to a JSON file, e.g. to compare two versions in review
+  --list               List the scenarios and exit
+
+No requests are sent to climate.weather.gc.ca; the station inventory and
+every bulk data file are served by a small HTTP server on localhost with
+synthetic data. Without any scenarios, all of them are run, e.g.
+python benchmark.py --json before.json find_station recodes
+"""
+
+import os
+import sys
+import json
+import random
+import platform
+import tracemalloc
+import threading
+import subprocess
+import ec3
+import requests
+import numpy as np
+import pandas as pd
+from docopt import docopt
+from io import StringIO
+from contextlib import redirect_stdout
+from tempfile import mkdtemp
+from datetime import date, datetime, timedelta
+from time import perf_counter
+from urllib.parse import urlparse, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREAMBLE = ('"Station Name","SYNTHETIC STATION"\n"Province","ONTARIO"\n'
+            '"Latitude","43.67"\n"Longitude","-79.40"\n"Elevation","112.50"\n'
+            '"Climate Identifier","6158355"\n"WMO Identifier","71508"\n'
+            '"TC Identifier","XTO"\n\n"Legend"\n"E","Estimated"\n"M","Missing"\n\n')
+
+DAILY_HEADER = ('"Date/Time","Year","Month","Day","Data Quality","Max Temp (°C)",'
+                '"Max Temp Flag","Min Temp (°C)","Min Temp Flag","Mean Temp (°C)",'
+                '"Mean Temp Flag","Total Precip (mm)","Total Precip Flag"\n')
+
+HOURLY_HEADER = ('"Longitude (x)","Latitude (y)","Station Name","Climate ID","Date/Time (LST)","Year",'
+                 '"Month","Day","Time (LST)","Temp (°C)","Temp Flag","Dew Point Temp (°C)",'
+                 '"Dew Point Temp Flag","Rel Hum (%)","Rel Hum Flag","Precip. Amount (mm)",'
+                 '"Precip. Amount Flag","Wind Dir (10s deg)","Wind Dir Flag","Wind Spd (km/h)",'
+                 '"Wind Spd Flag","Visibility (km)","Visibility Flag","Stn Press (kPa)",'
+                 '"Stn Press Flag","Hmdx","Hmdx Flag","Wind Chill","Wind Chill Flag","Weather"\n')
+
+PROVINCES = ["ALBERTA", "BRITISH COLUMBIA", "MANITOBA", "NEW BRUNSWICK", "NEWFOUNDLAND",
+             "NORTHWEST TERRITORIES", "NOVA SCOTIA", "NUNAVUT", "ONTARIO", "PRINCE EDWARD ISLAND",
+             "QUEBEC", "SASKATCHEWAN", "YUKON TERRITORY"]
+
+INVENTORY_HEADER = ('"Name","Province","Climate ID","Station ID","WMO ID","TC ID",'
+                    '"Latitude (Decimal Degrees)","Longitude (Decimal Degrees)","Latitude","Longitude",'
+                    '"Elevation (m)","First Year","Last Year","HLY First Year","HLY Last Year",'
+                    '"DLY First Year","DLY Last Year","MLY First Year","MLY Last Year"\n')
+
+
+def fake_inventory(n=8800, seed=1):
+    rng = random.Random(seed)
+    words = ["TORONTO", "OTTAWA", "LAKE", "RIVER", "CREEK", "POINT", "ISLAND", "MOUNT", "FORT",
+             "SAINT", "NORTH", "SOUTH", "AIRPORT", "CDA", "RCS", "INTL", "HARBOUR", "BAY"]
+    rows = ['"Modified Date","2021-01-01 00:00 UTC"\n',
+            '"Disclaimer","Synthetic inventory for benchmarking"\n', INVENTORY_HEADER]
+    sites = []
+    for i in range(n):
+        if sites and rng.random() < 0.15:
+            # Recoded station: same site, nearly the same coordinates, with a
+            # record that starts around where the previous one stopped
+            name, province, lat, lon, prev = rng.choice(sites)
+            lat += rng.uniform(-0.004, 0.004) if lat else 0
+            lon += rng.uniform(-0.004, 0.004) if lon else 0
+            first = min(prev + rng.randint(-2, 1), 2020)
+        else:
+            name, province = " ".join(rng.sample(words, 2)), rng.choice(PROVINCES)
+            # A few stations have placeholder coordinates, like the real inventory
+            lat = rng.uniform(42, 75) if rng.random() > 0.01 else 0
+            lon = -rng.uniform(52, 141) if rng.random() > 0.01 else 0
+            first = rng.randint(1840, 2015)
+        last = rng.randint(first, 2021)
+        sites.append((name, province, lat, lon, last))
+        years = []
+        for kind in range(3):
+            if rng.random() < 0.5:
+                years += [str(first), str(last)] if rng.random() < 0.5 else \
+                         [str(rng.randint(first, last)), str(last)]
+            else:
+                years += ["", ""]
+        rows.append('"{}","{}","{:07d}","{}","","","{:.4f}","{:.4f}","{}","{}","{:.1f}","{}","{}",{}\n'.format(
+          name, province, i, i + 1, lat, lon,
+          int(lat * 1e7), int(lon * 1e7), rng.uniform(0, 2000), first, last,
+          ",".join('"{}"'.format(y) for y in years)))
+    return "".join(rows)
+
+
+def fake_hourly_data(station, year, month, rng):
+    rows = [HOURLY_HEADER]
+    start = datetime(int(year), int(month), 1)
+    hour = start
+    while hour.month == start.month:
+        temp = rng.uniform(-10, 30)
+        rows.append('"-79.40","43.67","SYNTHETIC STATION","6158355","{0:%Y-%m-%d %H:%M}","{0:%Y}","{0:%m}",'
+                    '"{0:%d}","{0:%H:%M}","{1:.1f}","","{2:.1f}","","{3}","","","","{4}","","{5}","",'
+                    '"{6:.1f}","","{7:.2f}","","","","","","{8}"\n'.format(
+                      hour, temp, temp - rng.uniform(0, 10), rng.randint(20, 100), rng.randint(0, 36),
+                      rng.randint(0, 60), rng.uniform(0, 50), rng.uniform(97, 103),
+                      rng.choice(["NA", "Clear", "Mainly Clear", "Cloudy", "Snow", "Rain"])))
+        hour += timedelta(hours=1)
+    return "".join(rows)
+
+
+def fake_bulk_data(station, year, month, type):
+    rng = random.Random("{}-{}-{}-{}".format(station, year, month, type))
+    if str(type) == "1":
+        return fake_hourly_data(station, year, month, rng)
+    rows = [PREAMBLE, DAILY_HEADER]
+    for day in range(365):
+        d = date(int(year), 1, 1) + timedelta(days=day)
+        mx = rng.uniform(-10, 35)
+        mn = mx - rng.uniform(0, 15)
+        rows.append('"{0}","{0:%Y}","{0:%m}","{0:%d}","","{1:.1f}","","{2:.1f}","","{3:.1f}","","{4:.1f}","{5}"\n'.format(
+          d, mx, mn, (mx + mn) / 2, rng.expovariate(0.5), rng.choice(["", "", "", "T"])))
+    return "".join(rows)
+
+
+class FakeBulkHandler(BaseHTTPRequestHandler):
+
+    # Fraction of requests that fail, to exercise retries
+    fault_rate = 0.0
+    faults = ["503", "html", "drop"]
+    inventory = None
+
+    def do_GET(self):
+        if self.fault_rate and random.random() < self.fault_rate:
+            return self.send_fault(random.choice(self.faults))
+        url = urlparse(self.path)
+        if url.path == "/inventory.csv":
+            if FakeBulkHandler.inventory is None:
+                FakeBulkHandler.inventory = fake_inventory().encode("utf-8")
+            body = FakeBulkHandler.inventory
+        else:
+            query = dict(parse_qsl(url.query))
+            body = fake_bulk_data(query["stationID"], query["Year"], query["Month"],
+                                  query["timeframe"]).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_fault(self, fault):
+        if fault == "503":
+            self.send_error(503)
+        elif fault == "html":
+            # Maintenance pages come back as 200 OK
+            body = b"<!DOCTYPE html><html><body>Service temporarily unavailable</body></html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.close_connection = True
+            self.connection.shutdown(2)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(fault_rate=0.0):
+    FakeBulkHandler.fault_rate = fault_rate
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBulkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ec3.BULK_URL = "http://127.0.0.1:{}/climate_data/bulk_data_e.html".format(server.server_port)
+    ec3.INVENTORY_URL = "http://127.0.0.1:{}/inventory.csv".format(server.server_port)
+    return server
+
+
+def timed(fun, *args, **kwargs):
+    start = perf_counter()
+    fun(*args, **kwargs)
+    return perf_counter() - start
+
+
+# Every timing taken, for --json
+RESULTS = []
+
+
+def record(scenario, case, seconds, **extra):
+    RESULTS.append(dict(scenario=scenario, case=case, seconds=seconds, **extra))
+    return seconds
+
+
+def inventory_dir(n=8800):
+    workdir = mkdtemp()
+    with open(os.path.join(workdir, ec3.INVENTORY_FILE), 'w', encoding='utf-8') as file:
+        file.write(fake_inventory(n))
+    return workdir
+
+
+def reset_inventory():
+    # Forget the inventory and its indexes, as in a new process
+    ec3.clear_inventory()
+
+
+def bench_inventory_startup(runs=5):
+    """Latency of \"ec3 find\" from a cold process, parsing the CSV inventory
+    compared with loading the compiled copy"""
+    workdir = inventory_dir()
+    filename = os.path.join(workdir, ec3.INVENTORY_FILE)
+    script = os.path.abspath(ec3.__file__)
+    command = [sys.executable, script, "find", "--name", "Toronto", "--prov", "ON"]
+
+    def run():
+        return timed(subprocess.run, command, cwd=workdir, stdout=subprocess.DEVNULL, check=True)
+
+    compiled = ec3.compiled_inventory(filename)
+    csv = []
+    for i in range(runs):
+        if os.path.isfile(compiled):
+            os.remove(compiled)
+        csv.append(run())
+    binary = [run() for i in range(runs)] if ec3.feather is not None else [float('nan')]
+    # Process startup and imports are a shared baseline
+    baseline = [timed(subprocess.run, [sys.executable, "-c", "import ec3"], cwd=os.path.dirname(script),
+                      check=True) for i in range(runs)]
+    print("{:>24} {:>10}".format("ec3 find (best of {})".format(runs), "seconds"))
+    print("{:>24} {:>10.3f}".format("import only", record("inventory_startup", "import only", min(baseline))))
+    print("{:>24} {:>10.3f}".format("csv inventory", record("inventory_startup", "csv inventory", min(csv))))
+    print("{:>24} {:>10.3f}".format("compiled inventory",
+                                    record("inventory_startup", "compiled inventory", min(binary))))
+
+
+def legacy_parse_inventory(filename):
+    # How get_inventory parsed the inventory up to ec3 2.1.8, for comparison.
+    # "ec3 find" did this twice, once for each get_inventory behaviour.
+    inv = ec3.pd.read_csv(filename, skiprows = ec3.guess_skip(filename))
+    inv['Latitude (Decimal Degrees)'] = [i if i > 0 else '' for i in inv['Latitude (Decimal Degrees)']]
+    inv['Longitude (Decimal Degrees)'] = [i if i < 0 else '' for i in inv['Longitude (Decimal Degrees)']]
+    return inv
+
+
+def bench_inventory_load(runs=5):
+    """Time to load the inventory within a process, without the import overhead"""
+    filename = os.path.join(inventory_dir(), ec3.INVENTORY_FILE)
+    legacy = min(timed(legacy_parse_inventory, filename) for i in range(runs))
+    csv = min(timed(ec3.parse_inventory, filename) for i in range(runs))
+    print("{:>24} {:>10}".format("inventory load (best of {})".format(runs), "seconds"))
+    print("{:>24} {:>10.3f}".format("2.1.8 parse csv", record("inventory_load", "2.1.8 parse csv", legacy)))
+    print("{:>24} {:>10.3f}".format("parse csv", record("inventory_load", "parse csv", csv)))
+    if ec3.feather is not None:
+        ec3.compile_inventory(filename)
+        compiled = ec3.compiled_inventory(filename)
+        binary = min(timed(ec3.feather.read_feather, compiled) for i in range(runs))
+        print("{:>24} {:>10.3f}".format("load compiled", record("inventory_load", "load compiled", binary)))
+
+
+def bench_target_distance(runs=5, targets=((43.78, -79.19), (49.25, -123.1), (62.45, -114.37))):
+    """Distances to every station from a target, geopy's per-row geodesic (as
+    used up to ec3 2.1.8) against the vectorized path and the spatial index"""
+    try:
+        from geopy.distance import distance
+    except ImportError:
+        print("Skipping the distance benchmark, geopy is not installed.")
+        return
+    inv = ec3.parse_inventory(os.path.join(inventory_dir(), ec3.INVENTORY_FILE))
+    inv = inv[inv['Latitude (Decimal Degrees)'].notna() & inv['Longitude (Decimal Degrees)'].notna()]
+    lat = inv['Latitude (Decimal Degrees)'].values
+    lon = inv['Longitude (Decimal Degrees)'].values
+    index = ec3.StationIndex(lat, lon)
+
+    def legacy(p1):
+        return inv[['Latitude (Decimal Degrees)', 'Longitude (Decimal Degrees)']].apply(
+          lambda x: distance(tuple(x), p1).km, axis = 1).values
+
+    geopy = min(timed(legacy, targets[0]) for i in range(runs))
+    vectorized = min(timed(ec3.vincenty, targets[0][0], targets[0][1], lat, lon) for i in range(runs))
+    indexed = min(timed(index.query_radius, targets[0][0], targets[0][1], 100) for i in range(runs))
+    delta_v = max(np.abs(legacy(p) - ec3.vincenty(p[0], p[1], lat, lon)).max() for p in targets)
+    delta_h = max(np.abs(legacy(p) - ec3.haversine(p[0], p[1], lat, lon)).max() for p in targets)
+    record("target_distance", "geopy per row", geopy, stations=len(lat))
+    record("target_distance", "vincenty, all stations", vectorized, stations=len(lat), max_error_m=delta_v * 1000)
+    record("target_distance", "index, within 100 km", indexed, stations=len(lat))
+    print("{:>28} {:>10} {:>10} {:>14}".format(
+      "{} stations (best of {})".format(len(lat), runs), "seconds", "speedup", "max error (m)"))
+    print("{:>28} {:>10.4f} {:>10} {:>14}".format("geopy per row", geopy, "", ""))
+    print("{:>28} {:>10.4f} {:>10.0f} {:>14.6f}".format("vincenty, all stations", vectorized,
+                                                       geopy / vectorized, delta_v * 1000))
+    print("{:>28} {:>10.4f} {:>10.0f} {:>14}".format("index, within 100 km", indexed, geopy / indexed, ""))
+    print("{:>28} {:>10} {:>10} {:>14.1f}".format("haversine, all stations", "", "", delta_h * 1000))
+
+
+def bench_recodes(sizes=(8800, 35200), runs=3):
+    """Recode detection over a whole national inventory"""
+    print("{:>10} {:>10} {:>14}".format("stations", "seconds", "combinations"))
+    for n in sizes:
+        inv = ec3.parse_inventory(os.path.join(inventory_dir(n), ec3.INVENTORY_FILE))
+        secs = min(timed(ec3.find_recodes, [1981, 2010], 2, stations=inv) for i in range(runs))
+        combos = ec3.find_recodes([1981, 2010], 2, stations=inv).Combination.nunique()
+        record("recodes", "{} stations".format(n), secs, stations=n, combinations=int(combos))
+        print("{:>10} {:>10.3f} {:>14}".format(n, secs, combos))
+
+
+def legacy_parse_file(body, workdir):
+    # How each bulk data file was handled up to ec3 2.1.8: the encoding was
+    # detected, the text written to disk, then read twice.
+    r = requests.models.Response()
+    r._content = body
+    r.encoding = r.apparent_encoding
+    filename = os.path.join(workdir, "legacy.csv")
+    with open(filename, 'w', encoding='utf-8') as file:
+        file.write(r.content.decode())
+    return ec3.pd.read_csv(filename, skiprows = ec3.guess_skip(filename))
+
+
+def bench_parse(runs=20):
+    """Per-file CPU and I/O for parsing a downloaded bulk data file"""
+    workdir = mkdtemp()
+    body = fake_bulk_data(5051, 1990, 6, 2).encode('utf-8')
+    legacy = min(timed(legacy_parse_file, body, workdir) for i in range(runs))
+    single = min(timed(lambda: ec3.parse_bulk_data(body.decode('utf-8'))) for i in range(runs))
+    assert legacy_parse_file(body, workdir).equals(ec3.parse_bulk_data(body.decode('utf-8'))[0])
+    print("{:>28} {:>10}".format("parse one file (best of {})".format(runs), "ms"))
+    print("{:>28} {:>10.2f}".format("2.1.8 detect, write, re-read",
+                                    record("parse", "2.1.8 detect, write, re-read", legacy) * 1000))
+    print("{:>28} {:>10.2f}".format("single pass from memory",
+                                    record("parse", "single pass from memory", single) * 1000))
+
+
+def bench_get_data_faults(n=100, fault_rate=0.2):
+    """get_data against a server that fails a share of requests"""
+    FakeBulkHandler.fault_rate = fault_rate
+    backoff = ec3.BACKOFF
+    ec3.BACKOFF = 0.01
+    try:
+        stations = [5051 + i for i in range(n // 10)]
+        secs = timed(ec3.get_data, stations=stations, type=2, years=range(1990, 2000),
+                     progress=False, max_rps=None, cache=False, workers=4)
+    finally:
+        FakeBulkHandler.fault_rate = 0.0
+        ec3.BACKOFF = backoff
+    record("get_data_faults", "{:.0%} failing".format(fault_rate), secs, files=n)
+    print("{} files with {:.0%} of requests failing: {:.3f} seconds".format(n, fault_rate, secs))
+
+
+def bench_get_data_scaling(sizes=(10, 50, 100, 200)):
+    """Time per file should stay flat as the number of files grows"""
+    print("{:>8} {:>10} {:>14}".format("files", "seconds", "ms per file"))
+    for n in sizes:
+        stations = [5051 + i for i in range(n // 10)]
+        years = range(1990, 2000)
+        secs = timed(ec3.get_data, stations=stations, type=2, years=years,
+                     progress=False, max_rps=None, cache=False)
+        record("get_data_scaling", "{} daily files".format(n), secs, files=n)
+        print("{:>8} {:>10.3f} {:>14.2f}".format(n, secs, secs / n * 1000))
+
+
+def bench_parsers(counts=(1, 2, 4, 8), stations=4, years=(1990, 1991)):
+    """Typed hourly downloads from the cache, where parsing is the bottleneck,
+    with more and more parser processes"""
+    cache = ec3.Cache(path=mkdtemp())
+    kwargs = dict(stations=[5051 + i for i in range(stations)], type=1, years=years, progress=False,
+                  max_rps=None, cache=cache, workers=4, typed=True)
+    ec3.get_data(**kwargs)
+    n = stations * len(years) * 12
+    print("{:>8} {:>10} {:>14}  ({} hourly files, {} CPUs)".format("parsers", "seconds", "ms per file", n,
+                                                                 os.cpu_count()))
+    for parsers in counts:
+        secs = timed(ec3.get_data, parsers=parsers, **kwargs)
+        record("parsers", "{} parsers".format(parsers), secs, files=n, cpus=os.cpu_count())
+        print("{:>8} {:>10.3f} {:>14.2f}".format(parsers, secs, secs / n * 1000))
+
+
+def bench_inventory_download(runs=3):
+    """get_inventory() from a cold process with no inventory on disk, so that
+    it is downloaded and parsed"""
+    env = dict(os.environ, EC3_INVENTORY_URL=ec3.INVENTORY_URL,
+               PYTHONPATH=os.path.dirname(os.path.abspath(ec3.__file__)))
+    command = [sys.executable, "-c", "import ec3; ec3.get_inventory('session')"]
+    secs = min(timed(subprocess.run, command, cwd=mkdtemp(), env=env, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, check=True) for i in range(runs))
+    print("{:>24} {:>10}".format("cold start (best of {})".format(runs), "seconds"))
+    print("{:>24} {:>10.3f}".format("download and parse", record("inventory_download", "cold start", secs)))
+
+
+def bench_find_station(runs=5):
+    """find_station() with each kind of filter, on a national inventory"""
+    cases = [("name", dict(name="Toronto")),
+             ("name and province", dict(name="Toronto", province=["ON"])),
+             ("regex name", dict(name="^(LAKE|RIVER) ")),
+             ("period", dict(period=[1981, 2010], type=2)),
+             ("target", dict(target=(43.78, -79.19), dist=range(101))),
+             ("all filters", dict(name="Lake", province=["ON", "QC", "MB"], period=[1990, 2000], type=2,
+                                  target=(50.0, -90.0), dist=range(1001))),
+             ("period with recodes", dict(period=[1981, 2010], type=2, detect_recodes=True))]
+    cwd = os.getcwd()
+    os.chdir(inventory_dir())
+    try:
+        with redirect_stdout(StringIO()):
+            reset_inventory()
+            first = timed(ec3.find_station, name="Toronto")
+            results = [(case, min(timed(ec3.find_station, **kwargs) for i in range(runs)),
+                        ec3.find_station(**kwargs)) for case, kwargs in cases]
+    finally:
+        os.chdir(cwd)
+        reset_inventory()
+    print("{:>24} {:>10} {:>10}".format("find_station (best of {})".format(runs), "ms", "stations"))
+    print("{:>24} {:>10.2f} {:>10}".format("first search", record("find_station", "first search", first) * 1000, ""))
+    for case, secs, found in results:
+        rows = 0 if found is None else found.shape[0]
+        print("{:>24} {:>10.2f} {:>10}".format(case, record("find_station", case, secs, stations=rows) * 1000, rows))
+
+
+def bench_get_data_hourly(scales=((1, 1, 12), (2, 2, 12), (4, 3, 12))):
+    """Hourly get_data at growing station x year x month scales"""
+    print("{:>25} {:>8} {:>10} {:>14}".format("stations x years x months", "files", "seconds", "ms per file"))
+    for stations, years, months in scales:
+        n = stations * years * months
+        secs = timed(ec3.get_data, stations=[5051 + i for i in range(stations)], type=1,
+                     years=range(1990, 1990 + years), months=range(1, months + 1), progress=False,
+                     max_rps=None, cache=False, workers=4)
+        record("get_data_hourly", "{} x {} x {}".format(stations, years, months), secs, files=n)
+        print("{:>25} {:>8} {:>10.3f} {:>14.2f}".format("{} x {} x {}".format(stations, years, months), n,
+                                                       secs, secs / n * 1000))
+
+
+def resample_after(freq, agg, **kwargs):
+    """How an aggregate was computed before get_data(aggregate=...): all of
+    the rows first, then resampled"""
+    dat = ec3.get_data(typed=True, **kwargs)
+    datecol = [col for col in dat.columns if col.startswith("Date/Time")][0]
+    cols = ec3.measurement_columns(dat.columns)
+    return dat.groupby(["Station", pd.Grouper(key=datecol, freq=freq)])[cols].agg(agg)
+
+
+def bench_aggregate(stations=4, years=(1990, 1991)):
+    """Daily means and extremes of hourly data from the cache, resampled
+    after combining every row or aggregated as each file is parsed"""
+    cache = ec3.Cache(path=mkdtemp())
+    kwargs = dict(stations=[5051 + i for i in range(stations)], type=1, years=years, progress=False,
+                  max_rps=None, cache=cache, workers=4)
+    ec3.get_data(**kwargs)
+    n = stations * len(years) * 12
+    print("{:>22} {:>10} {:>14}  ({} hourly files)".format("case", "seconds", "peak MB", n))
+    for case, fun in [("resample after", lambda: resample_after("D", ["mean", "max", "min"], **kwargs)),
+                      ("aggregate", lambda: ec3.get_data(aggregate={"freq": "D", "agg": "mean,max,min"},
+                                                         **kwargs))]:
+        tracemalloc.start()
+        secs = timed(fun)
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+        record("aggregate", case, secs, files=n, peak_mb=peak)
+        print("{:>22} {:>10.3f} {:>14.1f}".format(case, secs, peak))
+
+
+SCENARIOS = {"get_data_scaling": bench_get_data_scaling,
+             "get_data_hourly": bench_get_data_hourly,
+             "get_data_faults": bench_get_data_faults,
+             "parsers": bench_parsers,
+             "aggregate": bench_aggregate,
+             "inventory_download": bench_inventory_download,
+             "inventory_startup": bench_inventory_startup,
+             "inventory_load": bench_inventory_load,
+             "find_station": bench_find_station,
+             "target_distance": bench_target_distance,
+             "recodes": bench_recodes,
+             "parse": bench_parse}
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+
+    if arguments['--list']:
+        for name, fun in SCENARIOS.items():
+            print("{:<20} {}".format(name, " ".join(fun.__doc__.split())))
+        sys.exit(0)
+
+    names = arguments['<scenario>'] or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        sys.exit("Unknown scenario(s): {}. Run with --list to see them.".format(", ".join(unknown)))
+
+    server = start_server()
+    for name in names:
+        print("#", name)
+        SCENARIOS[name]()
+        print()
+    server.shutdown()
+
+    if arguments['--json'] is not None:
+        with open(arguments['--json'], 'w', encoding='utf-8') as file:
+            json.dump(dict(ec3=ec3.__version__, python=platform.python_version(), platform=platform.platform(),
+                           cpus=os.cpu_count(), date=datetime.now().isoformat(timespec='seconds'),
+                           results=RESULTS), file, indent=2)
+        print("Saved the results to", arguments['--json'])
@@ -1,17 +1,28 @@
 """
 Usage:
-  ec3 inv
-  ec3 find [--name <name>] [--prov <province>...] [(--period <period> --type <type>)] [--recodes] [(--target <y> [<x>] [--dist <distance>])] [--outfile <filename>]
-  ec3 get -s <station>... [options] [--outfile <filename>]
+  ec3 inv [--stats] [--trace <file>]
+  ec3 find [--name <name>] [--prov <province>...] [(--period <period> --type <type>)] [--recodes [--tolerance <km>]] [(--target <y> [<x>] [--dist <distance>])] [--outfile <filename>] [--format <format>] [--stats] [--trace <file>]
+  ec3 find --targets-file <file> [--nearest <k>] [(--period <period> --type <type>)] [--dist <distance>] [--outfile <filename>] [--format <format>] [--stats] [--trace <file>]
+  ec3 get -s <station>... [options] [--resample <freq> [--agg <stats>]] [--outfile <filename>] [--format <format>] [--stats] [--trace <file>]
+  ec3 sync --store <dir> -s <station>... [options] [--format <format>] [--stats] [--trace <file>]
+  ec3 batch (<job>... | --watch <dir> [--interval <secs>]) [options] [--stats] [--trace <file>]
+  ec3 cache (stats | prune | clear)
   ec3 (-h | --help)
   ec3 --version
 
 Facilitates download of hourly, daily, or monthly climate data from Environment and Climate Change Canada
 
 Commands:
-  inv                  Download the inventory of available station data and exit
+  inv                  Download the inventory of available station data and exit. If pyarrow is
+                       installed, a compiled copy (.feather) is saved next to it for faster searches.
   find                 Search through the inventory for available data (see "Search Options", below)
   get                  Download data (see "Download Options", below)
+  sync                 Update a local store of data, downloading only what it is missing (see
+                       "Sync Options", below)
+  batch                Download many jobs together, fetching each file only once (see "Batch
+                       Options", below)
+  cache                Show statistics for the download cache, remove stale or excess files
+                       from it (prune), or empty it (clear)
 
 Search Options
   --name <name>        Filter stations by name, can use incomplete words, e.g. Tor
@@ -23,6 +34,12 @@ Search Options
   --dist <distance>    Colon-separated minimum and maximum distance from target [default: 0:100]
   --recodes            Pass this flag for the program to suggest stations that may be combined to
                        cover the period that you requested.
+  --tolerance <km>     Maximum distance between stations that --recodes may combine [default: 1]
+  --targets-file <file> A csv file of many targets, with an identifier in the first column followed
+                       by latitude (N) and longitude (W) in decimal degrees, as for --target. The
+                       nearest stations within the maximum --dist of each target are reported
+                       (the minimum must be 0).
+  --nearest <k>        Number of nearest stations to report for each target [default: 1]
 
 Downloading Options:
   -s <station>         Station code to download. Pass the argument multiple times for more than one
@@ -33,33 +50,98 @@ Downloading Options:
   -m <months>          Months to download, expressed as a range: e.g. 1:12
                        If no month is given, 1:12 will be used. (only applies to hourly data)
   --noprogress         Pass this flag to hide the download progress bar.
+  --workers <n>        Number of files to download concurrently [default: 1]
+  --max-rps <rate>     Maximum number of requests per second, shared by all workers [default: 4]
+  --parsers <n>        Number of processes to parse the downloaded files with [default: 1]
+  --retries <n>        Number of times to retry a failed download, waiting longer each time [default: 5]
+  --resume             Pass this flag to continue an interrupted download. Files downloaded so far
+                       are kept in <outfile>.partial until the download is complete.
+  --nocache            Pass this flag to bypass the download cache.
+  --chain              Pass this flag to combine the stations into one continuous series, e.g. when a
+                       station was recoded. Each year is downloaded from the first station given
+                       with -s that has data for it, according to the inventory.
+  --stream             Pass this flag to write each file to the output as soon as it is downloaded,
+                       instead of holding all of the data in memory. Not available for feather.
+  --resample <freq>    Resample the data of each station to this period, e.g. D (days), MS (months)
+                       or YS (years). Each file is aggregated as soon as it is downloaded, so only
+                       the aggregates are held in memory.
+  --agg <stats>        Comma-separated aggregates to compute for each period with --resample:
+                       mean, min, max, sum or count, e.g. mean,max,min [default: mean]
+
+Sync Options:
+  --store <dir>        Directory in which to keep the data. Takes the same -s, -t, --format,
+                       and download options as get. -y limits the years kept, otherwise all
+                       years in the inventory for each station are kept.
+
+Batch Options:
+  <job>                A JSON file describing a download, e.g. {"stations": [5051, 31688],
+                       "type": "daily", "years": "1990:2000", "outfile": "toronto.csv"}, with
+                       optional "months" and "format". Takes the download options of get.
+  --watch <dir>        Keep running, and download the jobs saved to this directory together.
+                       Each job file is renamed to .done or .failed once it is finished. Write
+                       jobs elsewhere and move them in, so that they are never read half-written.
+  --interval <secs>    How often to look for new jobs in the --watch directory [default: 5]
 
 Other options:
   --outfile <filename> Save your search results to a csv file or override the name for the
                        downloaded data.
+  --format <format>    Format of the output file: csv, parquet or feather [default: csv]
+                       Parquet and feather files keep the column types (dates, numbers, flags).
+                       Hourly parquet data (and any parquet data with --stream) is written as a
+                       directory partitioned by station and year. Requires pyarrow.
+  --stats              Print the time spent in each stage (download, parsing, filters, writing...),
+                       with the bytes downloaded, cache hits, retries and rows parsed.
+  --trace <file>       Save every timing and count, with the summary of --stats, to a JSON file.
   -h --help            Show this help text
   --version            Print the program version and exit
 
+Cache:
+  Downloaded files are kept in a local cache so that they are not downloaded again. Data for
+  periods that have ended is kept until it is evicted; data for the current month (hourly) or
+  year (daily, monthly) is fetched again on every run. The cache can be configured with the
+  following environment variables:
+    EC3_CACHE_DIR      Location of the cache [default: ~/.cache/ec3]
+    EC3_CACHE_SIZE     Size in MB beyond which least recently used files are evicted [default: 1024]
+    EC3_CACHE_TTL      Seconds for which data for the current period is reused [default: 0]
+
 Examples:
   ec3 inv # downloads the data inventory csv.
   ec3 search --name Toronto # find stations with "Toronto" in their name
   ec3 get -s 5051 -y 1981:2010 # creates a single daily .csv file for Toronto daily data
   ec3 get -s 5051 -y 1981:2010 -m 6:8 -t 1 # downloads hourly data for the summer months from 1981 to 2010 at Toronto
+  ec3 get -s 5051 -y 1981:2010 -t 1 --resample D --agg mean,max,min # daily means and extremes of hourly data
 """
 
 from docopt import docopt
 import re
 import os
+import csv
+import json
+import atexit
+import random
+import shutil
+import asyncio
+import numpy as np
 import pandas as pd
 import warnings
 from sys import exit
-from time import sleep
-from geopy.distance import distance
-from operator import itemgetter
-from tempfile import mkdtemp
+from time import sleep, monotonic, time
+from datetime import datetime
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_context, freeze_support
+from collections import deque
+from tempfile import mkdtemp, mkstemp, gettempdir
 from tqdm import tqdm
 from functools import lru_cache
-from requests import get
+from contextlib import contextmanager
+from requests import get, Session
+from requests.adapters import HTTPAdapter
+from io import StringIO
+try:
+    from pyarrow import feather
+except ImportError:
+    feather = None
 DEBUG = os.getenv('DEBUG', False)
 
 if not DEBUG:
@@ -67,31 +149,595 @@ if not DEBUG:
 
 __version__ = "2.1.8"
 
+BULK_URL = os.getenv('EC3_BULK_URL', "http://climate.weather.gc.ca/climate_data/bulk_data_e.html")
+
+# Seconds to wait for the server, and how failed downloads are retried
+TIMEOUT = 60
+RETRIES = 5
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+CACHE_DIR = os.getenv('EC3_CACHE_DIR', os.path.join(
+  os.getenv('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'ec3'))
+CACHE_SIZE = float(os.getenv('EC3_CACHE_SIZE', 1024))
+CACHE_TTL = float(os.getenv('EC3_CACHE_TTL', 0))
+
+
+class Metrics(object):
+    """Timers and counters for the stages of a search or download
+
+    Stages are timed with `with METRICS.timer(stage):` and counted with
+    METRICS.count(name, n). Every timing and count is also passed to each
+    function in hooks, as hook(kind, name, value) with kind "time" or
+    "count", e.g. to feed them to a monitoring system. Safe to use from
+    several threads.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.hooks = []
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+            self.started = monotonic()
+
+    def add_time(self, stage, seconds, calls=1):
+        with self.lock:
+            timer = self.timers.setdefault(stage, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+        for hook in self.hooks:
+            hook("time", stage, seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        for hook in self.hooks:
+            hook("count", name, n)
+
+    @contextmanager
+    def timer(self, stage):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(stage, monotonic() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {'timers': {stage: list(timer) for stage, timer in self.timers.items()},
+                    'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        """Add the timers and counters of another snapshot, e.g. from a
+        parser process"""
+        for stage, (calls, seconds) in snapshot['timers'].items():
+            self.add_time(stage, seconds, calls)
+        for name, n in snapshot['counters'].items():
+            self.count(name, n)
+
+    def summary(self):
+        snapshot = self.snapshot()
+        looked_up = snapshot['counters'].get('cache_hits', 0) + snapshot['counters'].get('cache_misses', 0)
+        return {'elapsed': monotonic() - self.started,
+                'stages': {stage: {'calls': calls, 'seconds': seconds}
+                           for stage, (calls, seconds) in snapshot['timers'].items()},
+                'counters': snapshot['counters'],
+                'cache_hit_rate': snapshot['counters'].get('cache_hits', 0) / looked_up if looked_up else None}
+
+
+METRICS = Metrics()
+
+
+def save_trace(filename, events):
+    with open(filename, 'w', encoding='utf-8') as file:
+        json.dump({'summary': METRICS.summary(), 'events': events}, file, indent=1)
+
+
+def format_stats(summary):
+    lines = ["{:<16} {:>8} {:>10}".format("Stage", "Calls", "Seconds")]
+    for stage, timer in sorted(summary['stages'].items(), key=lambda x: -x[1]['seconds']):
+        lines.append("{:<16} {:>8} {:>10.3f}".format(stage, timer['calls'], timer['seconds']))
+    for name, n in sorted(summary['counters'].items()):
+        if name == "bytes":
+            lines.append("{:<16} {:>8.1f} MB".format(name, n / 1e6))
+        else:
+            lines.append("{:<16} {:>8}".format(name, n))
+    if summary['cache_hit_rate'] is not None:
+        lines.append("{:<16} {:>8.0%}".format("cache hit rate", summary['cache_hit_rate']))
+    lines.append("{:<16} {:>8.3f} s".format("elapsed", summary['elapsed']))
+    return "\n".join(lines)
+
+
+class RateLimiter(object):
+    """Token bucket shared between download workers
+
+    Allows `rate` requests per second on average, with bursts of up to
+    `burst` requests. A rate of None or 0 disables limiting.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.last = monotonic()
+        self.lock = Lock()
+
+    def reserve(self):
+        """Take a token, returning how many seconds to wait before using it"""
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Reserve a token even if we have to wait for it, so that the
+            # next caller queues up behind us instead of racing us.
+            wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            METRICS.add_time("rate_limit", wait)
+            sleep(wait)
+
+
+def make_session(workers=1):
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def bulk_url(station, year, month, type):
+    return "{}?format=csv&stationID={}&Year={}&Month={}&Day=14&timeframe={}&submit=Download+Data".format(
+      BULK_URL, station, year, month, type)
+
+
+def bulk_filename(station, year, month, type):
+    if type == 1:
+        return "{}-hourly-{}-{}.csv".format(station, year, str(month).zfill(2))
+    elif type == 2:
+        return "{}-daily-{}.csv".format(station, year)
+    else:
+        return "{}-monthly.csv".format(station)
+
+
+DATE_FORMATS = {1: "%Y-%m-%d %H:%M", 2: "%Y-%m-%d", 3: "%Y-%m"}
+TEXT_COLUMNS = ["Station Name", "Climate ID", "Data Quality", "Time", "Time (LST)", "Weather",
+                "Spd of Max Gust (km/h)"]
+COORD_COLUMNS = ["Longitude (x)", "Latitude (y)"]
+OUTPUT_FORMATS = ["csv", "parquet", "feather"]
+
+
+def schema_dtypes(columns):
+    """The read_csv dtypes that give the columns of bulk data the types of
+    apply_schema(), except for dates and integers, which are converted
+    afterwards"""
+    dtypes = {}
+    for col in columns:
+        if col.startswith("Date/Time") or col in ["Year", "Month", "Day"]:
+            continue
+        elif col in COORD_COLUMNS:
+            dtypes[col] = 'float64'
+        elif col in TEXT_COLUMNS or col.endswith("Flag"):
+            dtypes[col] = 'category'
+        else:
+            dtypes[col] = 'float32'
+    return dtypes
+
+
+def apply_schema(dat, type):
+    """Convert the columns of bulk data to fixed types
+
+    Dates are parsed, measurements become float32 and flags and other text
+    become categoricals, so that every file of a timeframe has the same
+    schema regardless of what pd.read_csv would infer from its contents.
+    """
+    with METRICS.timer("schema"):
+        types = {}
+        for col in dat.columns:
+            if col == "Station":
+                continue
+            elif col.startswith("Date/Time"):
+                types[col] = pd.to_datetime(dat[col], format=DATE_FORMATS[type], errors='coerce')
+            elif col in ["Year", "Month", "Day"]:
+                types[col] = pd.to_numeric(dat[col], errors='coerce').astype('Int16')
+            elif col in COORD_COLUMNS:
+                types[col] = pd.to_numeric(dat[col], errors='coerce')
+            elif col in TEXT_COLUMNS or col.endswith("Flag"):
+                types[col] = dat[col].astype('string').astype('category')
+            else:
+                types[col] = pd.to_numeric(dat[col], errors='coerce').astype('float32')
+        return dat.assign(**types)
+
+
+def write_output(dat, outfile, format="csv", partition_cols=None, append=False):
+    with METRICS.timer("write"):
+        write_format(dat, outfile, format, partition_cols, append)
+
+
+def write_format(dat, outfile, format, partition_cols, append):
+    if format == "csv":
+        dat.to_csv(outfile, index=False, mode='a' if append else 'w', header=not append)
+    elif format == "parquet":
+        # Partitioned datasets get a new file for each write, so they can be appended to
+        if append and partition_cols is None:
+            raise Exception("Only partitioned parquet output can be appended to.")
+        if partition_cols is not None:
+            # Nullable integer partition keys cannot be read back by pyarrow
+            dat = dat.astype({col: 'int64' for col in partition_cols})
+        dat.to_parquet(outfile, index=False, partition_cols=partition_cols)
+    elif format == "feather":
+        if append:
+            raise Exception("Feather output cannot be appended to.")
+        dat.reset_index(drop=True).to_feather(outfile)
+    else:
+        raise Exception("Unknown output format.")
+
+
+def parse_bulk_filename(filename):
+    m = re.match(r'^(\d+)-(hourly|daily|monthly)(?:-(\d{4}))?(?:-(\d{2}))?\.csv$', os.path.basename(filename))
+    if m is None:
+        return None
+    type = ['hourly', 'daily', 'monthly'].index(m.group(2)) + 1
+    year = int(m.group(3)) if m.group(3) else None
+    month = int(m.group(4)) if m.group(4) else None
+    return int(m.group(1)), type, year, month
+
+
+def period_end(type, year, month):
+    """Timestamp at which a bulk data file stops changing, or None if it never does"""
+    if type == 1:
+        return datetime(year + (month == 12), month % 12 + 1, 1).timestamp()
+    elif type == 2:
+        return datetime(year + 1, 1, 1).timestamp()
+    else:
+        # Monthly files hold the whole record of a station.
+        return None
+
+
+class Cache(object):
+    """Persistent on-disk cache of bulk data files
+
+    Files are keyed by station, timeframe, year and month. A file that was
+    downloaded after its period ended is kept until it is evicted; a file
+    for a period that was still open is only reused for `ttl` seconds. Once
+    the cache grows beyond `max_size` MB, the least recently used files are
+    evicted.
+    """
+
+    def __init__(self, path=CACHE_DIR, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def key_path(self, station, type, year, month):
+        return os.path.join(self.path, str(station), bulk_filename(station, year, month, type))
+
+    def is_fresh(self, type, year, month, fetched):
+        end = period_end(type, year, month)
+        if end is not None and fetched >= end:
+            return True
+        return time() - fetched < self.ttl
+
+    def get(self, station, type, year, month):
+        filename = self.key_path(station, type, year, month)
+        try:
+            st = os.stat(filename)
+            fresh = self.is_fresh(type, year, month, st.st_mtime)
+            if fresh:
+                # atime records the last use for eviction, mtime the download time
+                os.utime(filename, (time(), st.st_mtime))
+        except OSError:
+            # e.g. evicted by another process sharing the cache
+            fresh = False
+        with self.lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return filename if fresh else None
+
+    def put(self, station, type, year, month, text):
+        target = self.key_path(station, type, year, month)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, part = mkstemp(dir=os.path.dirname(target), suffix=".part")
+        with open(fd, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(part, target)
+        return target
+
+    def is_stale(self, filename, st):
+        key = parse_bulk_filename(filename)
+        return key is None or not self.is_fresh(key[1], key[2], key[3], st.st_mtime)
+
+    def entries(self):
+        for root, dirs, files in os.walk(self.path):
+            for f in files:
+                filename = os.path.join(root, f)
+                try:
+                    yield filename, os.stat(filename)
+                except OSError:
+                    pass
+
+    def stats(self):
+        files = 0
+        size = 0
+        stale = 0
+        for filename, st in self.entries():
+            files += 1
+            size += st.st_size
+            stale += self.is_stale(filename, st)
+        return {'path': self.path, 'files': files, 'size': size / 1e6,
+                'max_size': self.max_size, 'stale': stale,
+                'hits': self.hits, 'misses': self.misses}
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda x: x[1].st_atime)
+        size = sum(st.st_size for f, st in entries)
+        removed = 0
+        for filename, st in entries:
+            if size <= self.max_size * 1e6:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            size -= st.st_size
+            removed += 1
+        return removed
+
+    def prune(self):
+        removed = 0
+        for filename, st in list(self.entries()):
+            if self.is_stale(filename, st):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    continue
+                removed += 1
+        return removed + self.evict()
+
+    def clear(self):
+        removed = sum(1 for entry in self.entries())
+        shutil.rmtree(self.path, ignore_errors=True)
+        return removed
+
+
+def is_html(text):
+    start = text.lstrip('\ufeff \t\r\n')[:15].lower()
+    return start.startswith('<!doctype html') or start.startswith('<html')
+
+
+class DownloadError(Exception):
+    """A file could still not be downloaded after every retry"""
+
+
+def response_error(status, text):
+    """Why a response has to be retried, or None if it holds the data"""
+    if status == 429 or status >= 500:
+        return "The server returned HTTP {}.".format(status)
+    elif status >= 400:
+        raise Exception("There was an error downloading that file! The server returned HTTP {}.".format(status))
+    elif is_html(text):
+        return "The server returned a web page instead of data."
+    return None
+
+
+def retry_delay(attempt, backoff, retry_after=None):
+    try:
+        wait = float(retry_after or 0)
+    except ValueError:
+        wait = 0
+    delay = min(MAX_BACKOFF, backoff * 2 ** attempt)
+    return max(wait, delay / 2 + random.uniform(0, delay / 2))
+
 
-def download_file(url, filename):
+def fetch_text(url, session=None, retries=RETRIES, backoff=None, limiter=None):
+    """Download a file and return its text
+
+    Connection errors, timeouts, server errors (5xx and 429) and web pages
+    served instead of data are retried up to `retries` times. The wait
+    doubles after each attempt, starting from `backoff` seconds, with
+    jitter so that workers do not retry in lockstep. With a RateLimiter,
+    every attempt, including each retry, waits for a token.
+    """
+    if backoff is None:
+        backoff = BACKOFF
+    for attempt in range(retries + 1):
+        retry_after = None
+        if limiter is not None:
+            limiter.acquire()
+        if DEBUG:
+            print("Downloading", url, "" if attempt == 0 else "(attempt {})".format(attempt + 1))
+        METRICS.count("requests")
+        try:
+            with METRICS.timer("download"):
+                r = get(url, timeout=TIMEOUT) if session is None else session.get(url, timeout=TIMEOUT)
+        except Exception as e:
+            error = "The error was: {}".format(e)
+        else:
+            METRICS.count("bytes", len(r.content))
+            # The files are UTF-8; detecting the encoding would scan the whole body
+            with METRICS.timer("decode"):
+                text = r.content.decode('utf-8', errors='replace')
+            error = response_error(r.status_code, text)
+            if error is None:
+                return text
+            retry_after = r.headers.get('Retry-After')
+        if attempt < retries:
+            METRICS.count("retries")
+            wait = retry_delay(attempt, backoff, retry_after)
+            METRICS.add_time("retry_wait", wait)
+            sleep(wait)
+    raise DownloadError("There was an error downloading that file after {} attempts! {}".format(retries + 1, error))
+
+
+def download_file(url, filename, session=None):
     if DEBUG:
         print("Downloading", os.path.basename(filename), "to",
           os.path.dirname(filename) if os.path.dirname(filename) != '' else "current working directory")
-    try:
-        r = get(url)
-    except Exception as e:
-        raise Exception("There was an error downloading that file! The error was: {}".format(e))
+    text = fetch_text(url, session=session)
+    with open(filename, 'w', encoding='utf-8') as file:
+        file.write(text)
+    return text
+
+
+def find_header(lines):
+    return lines.index(max(lines, key = len))
+
+
+# The header of a bulk data file comes after at most a short preamble
+HEADER_SEARCH_LINES = 64
+
+PREAMBLE_FIELDS = {"Station Name": "name", "Province": "province", "Latitude": "latitude",
+                   "Longitude": "longitude", "Elevation": "elevation", "Climate Identifier": "climate_id",
+                   "WMO Identifier": "wmo_id", "TC Identifier": "tc_id"}
+COLUMN_FIELDS = {"Station Name": "name", "Latitude (y)": "latitude", "Longitude (x)": "longitude",
+                 "Climate ID": "climate_id"}
+
+
+def read_preamble(lines):
+    """Station metadata from the key-value lines before the header"""
+    meta = {}
+    for row in csv.reader(lines):
+        if len(row) == 2 and row[0] in PREAMBLE_FIELDS:
+            value = row[1].strip()
+            if PREAMBLE_FIELDS[row[0]] in ['latitude', 'longitude', 'elevation']:
+                try:
+                    value = float(value)
+                except ValueError:
+                    value = None
+            meta[PREAMBLE_FIELDS[row[0]]] = value if value != '' else None
+    return meta
+
+
+def parse_bulk_data(text, type=None):
+    """Parse a bulk data file from memory
+
+    Returns the data and a dict of station metadata (name, province,
+    latitude, longitude, elevation, climate_id, wmo_id, tc_id, where
+    available), taken from the preamble or, for files without one, from the
+    first row of data. If the type of data is given, the columns are read
+    straight into the types of apply_schema(), without inferring them.
+    """
+    with METRICS.timer("find_header"):
+        text = text.lstrip('\ufeff')
+        head = text.split('\n', HEADER_SEARCH_LINES)[:HEADER_SEARCH_LINES]
+        skip = find_header(head)
+        start = sum(len(line) + 1 for line in head[:skip])
+        body = text[start:] if start else text
+    dat = None
+    if type is not None:
+        try:
+            dtypes = schema_dtypes(next(csv.reader([head[skip]])))
+            with METRICS.timer("read_csv"):
+                dat = pd.read_csv(StringIO(body), dtype=dtypes)
+        except (ValueError, TypeError):
+            # A value that does not fit its type; convert what we can instead
+            dat = None
+    if dat is not None:
+        with METRICS.timer("schema"):
+            types = {}
+            for col in dat.columns:
+                if col.startswith("Date/Time"):
+                    types[col] = pd.to_datetime(dat[col], format=DATE_FORMATS[type], errors='coerce')
+                elif col in ["Year", "Month", "Day"]:
+                    types[col] = pd.to_numeric(dat[col], errors='coerce').astype('Int16')
+                elif dtypes.get(col) == 'category':
+                    # Categories of strings, like apply_schema() gives
+                    values = dat[col].array
+                    types[col] = pd.Categorical.from_codes(values.codes, values.categories.astype('string'))
+            dat = dat.assign(**types)
     else:
-        r.encoding = r.apparent_encoding
-        with open(filename, 'w', encoding='utf-8') as file:
-            file.write(r.content.decode())
+        with METRICS.timer("read_csv"):
+            dat = pd.read_csv(StringIO(body))
+        if type is not None:
+            dat = apply_schema(dat, type)
+    METRICS.count("files_parsed")
+    METRICS.count("rows", dat.shape[0])
+    meta = read_preamble(head[:skip])
+    if dat.shape[0] > 0:
+        for col, field in COLUMN_FIELDS.items():
+            if field not in meta and col in dat.columns:
+                value = dat[col].iloc[0]
+                if pd.isnull(value):
+                    meta[field] = None
+                elif field in ['latitude', 'longitude']:
+                    meta[field] = float(value)
+                else:
+                    meta[field] = str(value)
+    return dat, meta
 
 
 def guess_skip(filename):
     with (open(filename, 'r', encoding='utf-8')) as file:
         lines = file.read().splitlines()
-    return lines.index(max(lines, key = len))
+    return find_header(lines)
+
+
+def compiled_inventory(filename):
+    return os.path.splitext(filename)[0] + ".feather"
+
+
+def parse_inventory(filename):
+    # Read the file once, and find the header in the text we already have
+    with open(filename, 'r', encoding='utf-8') as file:
+        text = file.read()
+    inv = pd.read_csv(StringIO(text), skiprows = find_header(text.splitlines()))
+    # Correct some placeholder coordinates
+    inv['Latitude (Decimal Degrees)'] = inv['Latitude (Decimal Degrees)'].where(inv['Latitude (Decimal Degrees)'] > 0)
+    inv['Longitude (Decimal Degrees)'] = inv['Longitude (Decimal Degrees)'].where(inv['Longitude (Decimal Degrees)'] < 0)
+    inv['Province'] = inv['Province'].astype('category')
+    return inv
+
+
+def compile_inventory(filename):
+    """Parse the station inventory and save a typed binary copy next to it
+
+    Returns the parsed inventory. The copy is only written if pyarrow is
+    available and the directory is writable.
+    """
+    inv = parse_inventory(filename)
+    if feather is not None:
+        try:
+            # Uncompressed, so that it loads without decompressing
+            feather.write_feather(inv, compiled_inventory(filename), compression="uncompressed")
+        except OSError:
+            pass
+    return inv
+
+
+@lru_cache()
+def load_inventory(filename):
+    compiled = compiled_inventory(filename)
+    if feather is not None and os.path.isfile(compiled) and \
+      os.path.getmtime(compiled) >= os.path.getmtime(filename):
+        return feather.read_feather(compiled)
+    return compile_inventory(filename)
+
+
+INVENTORY_URL = os.getenv('EC3_INVENTORY_URL',
+                          "https://docs.google.com/uc?export=download&id=1HDRnj41YBWpMioLPwAFiLlK4SK8NV72C")
+INVENTORY_FILE = "Station Inventory EN.csv"
+# Seconds that batch --watch plans jobs with the same copy of the inventory
+INVENTORY_TTL = float(os.getenv('EC3_INVENTORY_TTL', 86400))
 
 
 @lru_cache()
 def get_inventory(behaviour):
-    url = "https://docs.google.com/uc?export=download&id=1HDRnj41YBWpMioLPwAFiLlK4SK8NV72C"
-    filename = "Station Inventory EN.csv"
+    url = INVENTORY_URL
+    filename = INVENTORY_FILE
 
     if behaviour == "update":
         print("Downloading", filename, "to the current working directory")
@@ -110,13 +756,508 @@ def get_inventory(behaviour):
             else:
                 raise Exception("Unknown behaviour passed.")
 
-    inv = pd.read_csv(filename, skiprows = guess_skip(filename))
-    # Correct some placeholder coordinates (list comp because otherwise I get warnings)
-    inv['Latitude (Decimal Degrees)'] = [i if i > 0 else '' for i in inv['Latitude (Decimal Degrees)']]
-    inv['Longitude (Decimal Degrees)'] = [i if i < 0 else '' for i in inv['Longitude (Decimal Degrees)']]
-    return inv
+    if behaviour == "update":
+        load_inventory.cache_clear()
+        return compile_inventory(filename)
+    return load_inventory(os.path.abspath(filename))
+
+EARTH_RADIUS = 6371.0088
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km on a spherical Earth, vectorized"""
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2)]
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(h))
+
 
-def find_station(name=None, province=None, period=None, type=None, detect_recodes=False, target=None, dist=range(101)):
+def vincenty(lat1, lon1, lat2, lon2, iterations=200, tol=1e-12):
+    """Distance in km on the WGS-84 ellipsoid (Vincenty's inverse formula), vectorized
+
+    Agrees with geopy's geodesic distance to well under a metre, except for
+    nearly antipodal points, which the iteration does not converge for.
+    """
+    a = WGS84_A
+    f = WGS84_F
+    b = (1 - f) * a
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(
+      *[np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2)])
+    L = lon2 - lon1
+    U1 = np.arctan((1 - f) * np.tan(lat1))
+    U2 = np.arctan((1 - f) * np.tan(lat2))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i in range(iterations):
+            sinlam, coslam = np.sin(lam), np.cos(lam)
+            sinsig = np.sqrt((cosU2 * sinlam) ** 2 + (cosU1 * sinU2 - sinU1 * cosU2 * coslam) ** 2)
+            cossig = sinU1 * sinU2 + cosU1 * cosU2 * coslam
+            sig = np.arctan2(sinsig, cossig)
+            # Coincident points have sinsig == 0
+            sinalpha = np.where(sinsig == 0, 0, cosU1 * cosU2 * sinlam / sinsig)
+            cos2alpha = 1 - sinalpha ** 2
+            # Equatorial lines have cos2alpha == 0
+            cos2sigm = np.where(cos2alpha == 0, 0, cossig - 2 * sinU1 * sinU2 / cos2alpha)
+            C = f / 16 * cos2alpha * (4 + f * (4 - 3 * cos2alpha))
+            prev = lam
+            lam = L + (1 - C) * f * sinalpha * (sig + C * sinsig * (cos2sigm + C * cossig * (-1 + 2 * cos2sigm ** 2)))
+            if not np.any(np.abs(lam - prev) > tol):
+                break
+
+    u2 = cos2alpha * (a ** 2 - b ** 2) / b ** 2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    dsig = B * sinsig * (cos2sigm + B / 4 * (cossig * (-1 + 2 * cos2sigm ** 2) -
+                         B / 6 * cos2sigm * (-3 + 4 * sinsig ** 2) * (-3 + 4 * cos2sigm ** 2)))
+    return b * A * (sig - dsig) / 1000
+
+
+def unit_vectors(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class StationIndex(object):
+    """Spatial index over station coordinates
+
+    Stations are stored as points on the unit sphere, so that a distance
+    range becomes a radius query. The query uses a k-d tree if scipy is
+    installed, and a vectorized scan otherwise. Candidates are then
+    measured exactly with vincenty(). Stations with missing coordinates are
+    never returned.
+    """
+
+    # The sphere is used for candidates only; a little slack makes sure that
+    # no station within range on the ellipsoid (< 0.6% longer) is missed.
+    margin = 0.01
+
+    def __init__(self, lat, lon):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.valid = np.flatnonzero(~np.isnan(self.lat) & ~np.isnan(self.lon))
+        self.xyz = unit_vectors(self.lat[self.valid], self.lon[self.valid])
+        # Imported here rather than with ec3, since it takes a while to load
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            cKDTree = None
+        self.tree = cKDTree(self.xyz) if cKDTree is not None else None
+
+    def query_nearest(self, lat, lon, k=1, max_dist=None):
+        """The k nearest stations to each of many points
+
+        Returns flat arrays of target positions, station positions,
+        distances in km and ranks (from 1), sorted by target and distance.
+        """
+        lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        n = len(self.valid)
+        # Extra candidates from the sphere, re-ranked on the ellipsoid
+        m = min(n, k + max(k, 4))
+        p = unit_vectors(lat, lon)
+        if max_dist is None:
+            chord = np.inf
+        else:
+            chord = 2 * np.sin(min(max_dist * (1 + self.margin) / EARTH_RADIUS, np.pi) / 2)
+
+        if m == 0:
+            cand = np.zeros((len(lat), 0), dtype=int)
+        elif self.tree is not None:
+            chords, cand = self.tree.query(p, k=m, distance_upper_bound=chord)
+            cand = cand.reshape(len(lat), m)
+        else:
+            cand = np.empty((len(lat), m), dtype=int)
+            for start in range(0, len(lat), 512):
+                chunk = slice(start, start + 512)
+                d2 = 2 - 2 * p[chunk] @ self.xyz.T
+                part = np.argpartition(d2, m - 1, axis=1)[:, :m]
+                cand[chunk] = np.where(np.take_along_axis(d2, part, axis=1) <= chord ** 2, part, n)
+
+        t = np.repeat(np.arange(len(lat)), cand.shape[1])
+        c = cand.ravel()
+        # Missing neighbours are flagged with position n
+        t, c = t[c < n], c[c < n]
+        pos = self.valid[c]
+        d = vincenty(lat[t], lon[t], self.lat[pos], self.lon[pos])
+        keep = ~np.isnan(d) if max_dist is None else d <= max_dist
+        t, pos, d = t[keep], pos[keep], d[keep]
+
+        order = np.lexsort((pos, d, t))
+        t, pos, d = t[order], pos[order], d[order]
+        rank = np.arange(len(t)) - np.searchsorted(t, t, side='left')
+        keep = rank < k
+        return t[keep], pos[keep], d[keep], rank[keep] + 1
+
+    def query_radius(self, lat, lon, max_dist):
+        """Positions (in the original arrays) and distances in km of
+        stations within max_dist km of a point"""
+        angle = min(max_dist * (1 + self.margin) / EARTH_RADIUS, np.pi)
+        chord = 2 * np.sin(angle / 2)
+        p = unit_vectors(lat, lon)
+        if self.tree is not None:
+            cand = np.asarray(self.tree.query_ball_point(p, chord), dtype=int)
+        else:
+            cand = np.flatnonzero(((self.xyz - p) ** 2).sum(axis=1) <= chord ** 2)
+        pos = self.valid[cand]
+        d = vincenty(lat, lon, self.lat[pos], self.lon[pos])
+        keep = d <= max_dist
+        return pos[keep], d[keep]
+
+
+# The name of each province in the inventory
+PROVINCE_NAMES = {"AB": "ALBERTA", "BC": "BRITISH COLUMBIA", "MB": "MANITOBA", "NB": "NEW BRUNSWICK",
+                  "NL": "NEWFOUNDLAND", "NT": "NORTHWEST TERRITORIES", "NS": "NOVA SCOTIA", "NU": "NUNAVUT",
+                  "ON": "ONTARIO", "PE": "PRINCE EDWARD ISLAND", "QC": "QUEBEC", "SK": "SASKATCHEWAN",
+                  "YT": "YUKON TERRITORY"}
+PROVINCE_CODES = list(PROVINCE_NAMES)
+YEAR_COLUMNS = {1: ['HLY First Year', 'HLY Last Year'],
+                2: ['DLY First Year', 'DLY Last Year'],
+                3: ['MLY First Year', 'MLY Last Year']}
+
+
+def year_columns(type):
+    if type == 1 or str(type)[0] in ['1', 'h', 'H']:
+        return YEAR_COLUMNS[1]
+    elif type == 2 or str(type)[0] in ['2', 'd', 'D']:
+        return YEAR_COLUMNS[2]
+    elif type == 3 or str(type)[0] in ['3', 'm', 'M']:
+        return YEAR_COLUMNS[3]
+    return None
+
+
+class InventoryIndex(object):
+    """Precomputed lookups over the station inventory
+
+    Every filter returns a boolean array over the rows of the inventory, so
+    that filters can be combined without copying the inventory; only the
+    rows that pass are taken from it at the end. Name matches are memoized,
+    since the same patterns tend to be searched again and again.
+    """
+
+    def __init__(self, inv):
+        # The inventory that the positions returned by search() refer to
+        self.inv = inv
+        self.size = inv.shape[0]
+        self.names = inv.Name.fillna('').to_numpy(dtype=str)
+        self.upper_names = pd.Series(np.char.upper(self.names))
+        province = inv.Province.astype('category')
+        self.province_codes = province.cat.codes.to_numpy()
+        # The category of each province code, or None if no station is in it
+        categories = {str(name).strip().upper(): i for i, name in enumerate(province.cat.categories)}
+        self.province_lookup = {code: categories.get(name) for code, name in PROVINCE_NAMES.items()}
+        self.years = {t: (inv[cols[0]].to_numpy(dtype=float), inv[cols[1]].to_numpy(dtype=float))
+                      for t, cols in YEAR_COLUMNS.items()}
+        self.station_rows = pd.Index(inv['Station ID'])
+        self.station_index = None
+        self.name_mask = lru_cache(maxsize=1024)(self.match_name)
+
+    @property
+    def spatial(self):
+        """StationIndex of the coordinates, built when a search first needs it"""
+        if self.station_index is None:
+            self.station_index = StationIndex(self.inv['Latitude (Decimal Degrees)'],
+                                              self.inv['Longitude (Decimal Degrees)'])
+        return self.station_index
+
+    def match_name(self, name):
+        if re.escape(name) == name:
+            # Plain text needs no regular expression
+            mask = self.upper_names.str.contains(name.upper(), regex=False).to_numpy()
+        else:
+            nmreg = re.compile(name, flags = re.IGNORECASE)
+            mask = np.fromiter((nmreg.search(n) is not None for n in self.names), dtype=bool, count=self.size)
+        mask.flags.writeable = False
+        return mask
+
+    def province_mask(self, province):
+        if isinstance(province, str):
+            province = [province]
+        p_pass = [i.upper() for i in province]
+        if not all([len(i) == 2 for i in p_pass]):
+            return np.ones(self.size, dtype=bool)
+        if not all([i in PROVINCE_CODES for i in p_pass]):
+            raise Exception("Incorrect province code(s) provided.")
+        return np.isin(self.province_codes, [self.province_lookup[i] for i in p_pass
+                                             if self.province_lookup[i] is not None])
+
+    def period_mask(self, period, type):
+        if not hasattr(period, '__len__'):
+            period = [period]
+        first, last = self.years[parse_type(type)]
+        return (first <= min(period)) & (last >= max(period))
+
+    def station_coords(self, station):
+        row = self.station_rows.get_loc(station)
+        return self.spatial.lat[row], self.spatial.lon[row]
+
+    def mask(self, name=None, province=None, period=None, type=None):
+        """Rows passing all of the given filters"""
+        mask = np.ones(self.size, dtype=bool)
+        if name is not None:
+            mask &= self.name_mask(name)
+        if province is not None:
+            mask &= self.province_mask(province)
+        if period is not None and type is not None:
+            mask &= self.period_mask(period, type)
+        return mask
+
+    def search(self, name=None, province=None, period=None, type=None, target=None, dist=range(101)):
+        """Rows passing all of the given filters, and their distance in km
+        from target (None if no target was given), nearest first"""
+        mask = self.mask(name=name, province=province, period=period, type=type)
+        if target is None:
+            return np.flatnonzero(mask), None
+        if isinstance(target, (int, np.integer)):
+            target = self.station_coords(target)
+        pos, d = self.spatial.query_radius(target[0], target[1], max(dist))
+        keep = mask[pos] & (d >= min(dist))
+        pos, d = pos[keep], d[keep]
+        order = np.argsort(pos)
+        pos, d = pos[order], d[order]
+        order = np.argsort(d, kind='stable')
+        return pos[order], d[order]
+
+
+@lru_cache()
+def get_inventory_index(behaviour):
+    return InventoryIndex(get_inventory(behaviour=behaviour))
+
+
+def clear_inventory():
+    """Forget the inventory loaded by this process, so that it is read (or,
+    with behaviour="session" and no local copy, downloaded) again"""
+    get_inventory.cache_clear()
+    load_inventory.cache_clear()
+    get_inventory_index.cache_clear()
+
+
+def cluster_points(lat, lon, tolerance):
+    """Label points so that any two within tolerance km share a label"""
+    xyz = unit_vectors(lat, lon)
+    n = len(xyz)
+    chord = 2 * np.sin(min(tolerance / EARTH_RADIUS, np.pi) / 2)
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        cKDTree = None
+    if cKDTree is not None:
+        pairs = cKDTree(xyz).query_pairs(chord, output_type='ndarray')
+    else:
+        pairs = []
+        for start in range(0, n, 512):
+            d2 = 2 - 2 * xyz[start:start + 512] @ xyz.T
+            i, j = np.nonzero(d2 <= chord ** 2 + 1e-12)
+            keep = i + start < j
+            pairs.append(np.stack([i[keep] + start, j[keep]], axis=1))
+        pairs = np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=int)
+
+    # Propagate the smallest label through each pair until nothing changes
+    labels = np.arange(n)
+    while len(pairs):
+        prev = labels.copy()
+        low = np.minimum(labels[pairs[:, 0]], labels[pairs[:, 1]])
+        np.minimum.at(labels, pairs[:, 0], low)
+        np.minimum.at(labels, pairs[:, 1], low)
+        labels = labels[labels]
+        if np.array_equal(labels, prev):
+            break
+    return labels
+
+
+def cover_period(first, last, start, end):
+    """Positions of the fewest intervals that together cover start to end
+    without a gap in years, or None if they cannot"""
+    order = np.argsort(first, kind='stable')
+    chain = []
+    reach = start - 1
+    best = None
+    i = 0
+    while reach < end:
+        while i < len(order) and first[order[i]] <= reach + 1:
+            if best is None or last[order[i]] > last[best]:
+                best = order[i]
+            i += 1
+        if best is None or last[best] <= reach:
+            return None
+        chain.append(best)
+        reach = last[best]
+    return chain
+
+
+def find_recodes(period, type, stations=None, tolerance=1):
+    """Find stations that can be combined to cover a period
+
+    Stations are sometimes recoded, so that one site's record is split
+    between several station codes. Stations within tolerance km of each
+    other are grouped, and each group is searched for the fewest stations
+    whose records, one after another, cover period.
+
+    Parameters
+    ----------
+    period : int or range
+        Range of years for which data must be available
+    type : int or str
+        The type of data to search for
+        Options are: 1, hourly; 2, daily; 3, monthly
+
+    Optional Parameters
+    ----------
+    stations : DataFrame
+        The stations to search, as rows of the inventory; Default: the
+        whole inventory.
+    tolerance : float
+        Maximum distance (in km) between stations that may be combined;
+        Default: 1.
+
+    Returns a DataFrame with one row per station of each combination, in
+    order, with a Combination column numbering the combinations.
+    """
+
+    if stations is None:
+        stations = get_inventory(behaviour="session")
+    if not hasattr(period, '__len__'):
+        period = [period]
+    wantcols = year_columns(type)
+    if wantcols is None:
+        raise Exception("Invalid type passed.")
+    cols = ['Station ID', 'Name', 'Latitude (Decimal Degrees)', 'Longitude (Decimal Degrees)'] + wantcols
+
+    first = stations[wantcols[0]].to_numpy(dtype=float)
+    last = stations[wantcols[1]].to_numpy(dtype=float)
+    lat = stations['Latitude (Decimal Degrees)'].to_numpy(dtype=float)
+    lon = stations['Longitude (Decimal Degrees)'].to_numpy(dtype=float)
+    # Stations that cover the period alone need no partner, and stations
+    # without data in the period cannot contribute to it.
+    cand = np.flatnonzero(~np.isnan(first) & ~np.isnan(last) & ~np.isnan(lat) & ~np.isnan(lon) &
+                          ~((first <= min(period)) & (last >= max(period))) &
+                          (first <= max(period)) & (last >= min(period)))
+    if len(cand) < 2:
+        return pd.DataFrame(columns=['Combination'] + cols)
+
+    labels = cluster_points(lat[cand], lon[cand], tolerance)
+    order = np.argsort(labels, kind='stable')
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    chains = []
+    for group in np.split(cand[order], bounds):
+        if len(group) < 2:
+            continue
+        chain = cover_period(first[group], last[group], min(period), max(period))
+        if chain is not None:
+            chains.append(group[chain])
+
+    if len(chains) == 0:
+        return pd.DataFrame(columns=['Combination'] + cols)
+    rows = np.concatenate(chains)
+    combo = np.repeat(np.arange(1, len(chains) + 1), [len(c) for c in chains])
+    res = stations.iloc[rows][cols].assign(Combination=combo)
+    return res[['Combination'] + cols]
+
+
+def search_stations(queries):
+    """Run many station searches in one call
+
+    Parameters
+    ----------
+    queries : list of dict
+        Each search, as a dict of any of the arguments name, province,
+        period, type, target and dist, with the same meaning as in
+        find_station().
+
+    Returns a DataFrame of the matching stations for all searches, with a
+    Query column giving the position of the search in queries (and a Dist
+    column if any search has a target). Stations matching several searches
+    are repeated.
+    """
+
+    index = get_inventory_index("session")
+    inv = index.inv
+
+    rows = []
+    query = []
+    dists = []
+    for i, q in enumerate(queries):
+        r, d = index.search(**q)
+        rows.append(r)
+        query.append(np.full(len(r), i))
+        dists.append(np.full(len(r), np.nan) if d is None else d)
+
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+    res = inv.iloc[rows].assign(Query=np.concatenate(query) if query else [])
+    if any(q.get('target') is not None for q in queries):
+        res = res.assign(Dist=np.concatenate(dists))
+    cols = res.columns.tolist()
+    return res[['Query'] + [c for c in cols if c != 'Query']]
+
+
+def nearest_stations(targets, k=1, max_dist=None, type=None, period=None):
+    """Find the stations nearest to many targets at once
+
+    Parameters
+    ----------
+    targets : list or DataFrame
+        Pairs of latitude and longitude in decimal degrees (negative for W),
+        or a DataFrame whose first two columns are latitude and longitude,
+        in which case its index identifies the targets.
+
+    Optional Parameters
+    ----------
+    k : int
+        Number of stations to return for each target; Default: 1.
+    max_dist : float
+        Maximum distance from a target (in km).
+    type : int or str
+        The type of data that stations must have (required if period is not None)
+        Options are: 1, hourly; 2, daily; 3, monthly
+    period : int or range
+        Range of years for which data must be available
+
+    Returns a DataFrame with one row per target and station, and the columns
+    Target, Station ID, Name, Dist (in km) and Rank (1 is the nearest).
+    """
+
+    inventory = get_inventory_index("session")
+    inv = inventory.inv
+
+    if isinstance(targets, pd.DataFrame):
+        labels = targets.index
+        coords = targets.iloc[:, :2].to_numpy(dtype=float)
+    else:
+        coords = np.asarray(targets, dtype=float).reshape(-1, 2)
+        labels = pd.RangeIndex(len(coords))
+
+    wantcols = None
+    if period is not None:
+        if not hasattr(period, '__len__'):
+            period = [period]
+        if type is None:
+            warnings.warn("No data type passed. Ignoring data filter.")
+        else:
+            wantcols = year_columns(type)
+            if wantcols is None:
+                warnings.warn("Invalid data type passed. Ignoring data filter.")
+
+    if wantcols is None:
+        index = inventory.spatial
+    else:
+        ok = (inv[wantcols[0]] <= min(period)) & (inv[wantcols[1]] >= max(period))
+        index = StationIndex(inv['Latitude (Decimal Degrees)'].where(ok),
+                             inv['Longitude (Decimal Degrees)'].where(ok))
+
+    t, pos, d, rank = index.query_nearest(coords[:, 0], coords[:, 1], k=k, max_dist=max_dist)
+    return pd.DataFrame({'Target': labels[t],
+                         'Station ID': inv['Station ID'].values[pos],
+                         'Name': inv['Name'].values[pos],
+                         'Dist': d,
+                         'Rank': rank})
+
+
+def find_station(name=None, province=None, period=None, type=None, detect_recodes=False, target=None, dist=range(101),
+                 tolerance=1):
     """Find data available in the Environment and Climate Change Canada
     historical data archive
 
@@ -133,40 +1274,36 @@ def find_station(name=None, province=None, period=None, type=None, detect_recode
         Options are: 1, hourly; 2, daily; 3, monthly
     detect_recodes : Boolean
         Whether to try to detect stations that have been recoded when
-        searching for stations that provide enough data for period.
+        searching for stations that provide enough data for period
+        (see find_recodes).
     target : tuple or int
         Either the station code of a target station, or a tuple of
         latitude and longitude to use as a target.
     dist : range
         Desired distance from target (in km); Default: range(101).
+    tolerance : float
+        Maximum distance (in km) between stations that detect_recodes may
+        combine; Default: 1.
     """
 
-    inv = get_inventory(behaviour="session")
-    filt = inv.copy()
+    with METRICS.timer("inventory"):
+        index = get_inventory_index("session")
+        inv = index.inv
+    mask = np.ones(index.size, dtype=bool)
 
     if name is not None:
-        nmreg = re.compile(name, flags = re.IGNORECASE)
-        filt = filt[filt.Name.isin(list(filter(nmreg.search, filt.Name)))]
+        with METRICS.timer("name_filter"):
+            mask &= index.name_mask(name)
 
-        if filt.shape[0] == 0:
+        if not mask.any():
             print("No results!")
             return
 
     if province is not None:
-        p_pass = [i.upper() for i in province]
-        p_codes = ["AB", "BC", "MB", "NB", "NL", "NT", "NS", "NU", "ON", "PE",
-                    "QC", "SK", "YT"]
-        if all([len(i) == 2 for i in p_pass]):
-            if not all([i.upper() in p_codes for i in province]):
-                raise Exception("Incorrect province code(s) provided.")
-            indeces = [i for i, x in enumerate([i in p_pass for i in p_codes]) if x]
-            pull_prov = itemgetter(*indeces)(sorted(list(set(inv.Province))))
-            if isinstance(pull_prov, str):
-                pull_prov = [pull_prov]
-
-            filt = filt[filt.Province.isin(pull_prov)]
+        with METRICS.timer("province_filter"):
+            mask &= index.province_mask(province)
 
-        if filt.shape[0] == 0:
+        if not mask.any():
             print("No results!")
             return
 
@@ -175,68 +1312,49 @@ def find_station(name=None, province=None, period=None, type=None, detect_recode
         if type is None:
             warnings.warn("No data type passed. Ignoring data filter.")
         else:
-            if type == 1 or type[0] in ['1', 'h', 'H']:
-                wantcols = ['HLY First Year', 'HLY Last Year']
-                dropcols = ['DLY First Year', 'DLY Last Year', 'MLY First Year', 'MLY Last Year']
-            elif type == 2 or type[0] in ['2', 'd', 'D']:
-                wantcols = ['DLY First Year', 'DLY Last Year']
-                dropcols = ['HLY First Year', 'HLY Last Year', 'MLY First Year', 'MLY Last Year']
-            elif type == 3 or type[0] in ['3' 'm', 'M']:
-                wantcols = ['MLY First Year', 'MLY Last Year']
-                dropcols = ['HLY First Year', 'HLY Last Year', 'DLY First Year', 'DLY Last Year']
-            else:
+            wantcols = year_columns(type)
+            if wantcols is None:
                 period = None
                 warnings.warn("Invalid data type passed. Ignoring data filter.")
+            else:
+                dropcols = [c for cols in YEAR_COLUMNS.values() for c in cols if c not in wantcols]
 
     if target is not None:
-        if isinstance(target, int):
-            coords = inv[['Latitude (Decimal Degrees)', 'Longitude (Decimal Degrees)']][inv['Station ID'] == target]
-            p1 = tuple(coords.values[0])
-        elif len(target) == 2:
-            p1 = target
-
-        filt = filt.assign(Dist = filt[['Latitude (Decimal Degrees)', 'Longitude (Decimal Degrees)']].apply(lambda x: distance(tuple(x), p1), axis = 1))
-        filt = filt[(filt.Dist <= max(dist)) & (filt.Dist >= min(dist))]
-
-        if filt.shape[0] == 0:
+        if not isinstance(target, int) and len(target) != 2:
+            raise Exception("Target must be a station code or a pair of coordinates.")
+        with METRICS.timer("target_filter"):
+            rows, d = index.search(target=target, dist=dist)
+        keep = mask[rows]
+        rows, d = rows[keep], d[keep]
+
+        if len(rows) == 0:
             print("No results!")
             return
 
-        filt = filt.sort_values('Dist')
+        filt = inv.iloc[rows].assign(Dist = d)
+    else:
+        rows = np.flatnonzero(mask)
+        filt = inv.iloc[rows]
 
     if period is not None:
         filt = filt.drop(dropcols, axis=1)
-        inside = filt[(filt[wantcols[0]] <= min(period)) & (filt[wantcols[1]] >= max(period))]
-        outside = filt[~filt['Station ID'].isin(inside['Station ID'])]
-        filt = inside
+        with METRICS.timer("period_filter"):
+            inside = index.period_mask(period, type)[rows]
+        outside = filt[~inside]
+        filt = filt[inside]
 
         if detect_recodes:
-            # Try to detected cases where the StationID has changed
-            coords = outside[['Station ID', 'Latitude (Decimal Degrees)', 'Longitude (Decimal Degrees)']].groupby(['Latitude (Decimal Degrees)', 'Longitude (Decimal Degrees)']).count().reset_index()
-            coords = coords[coords['Station ID'] > 1]
-            coords = coords[(coords['Latitude (Decimal Degrees)'] != "") & (coords['Longitude (Decimal Degrees)'] != "")]
-            printed = False
-            for rw in coords.index:
-                dups = outside[(outside['Latitude (Decimal Degrees)'] == coords['Latitude (Decimal Degrees)'][rw]) &
-                               (outside['Longitude (Decimal Degrees)'] == coords['Longitude (Decimal Degrees)'][rw])]
-                dups = dups.sort_values('Station ID')   # There is an annoying warning here.
-                if (~dups[wantcols[0]].isnull().any()) & (min(dups[wantcols[0]]) <= min(period)):
-                    if (~dups[wantcols[1]].isnull().any()) & (max(dups[wantcols[1]]) >= max(period)):
-                        if min(dups[wantcols[1]]) <= max(dups[wantcols[0]]):
-                            if not printed:
-                                print("Note: In addition to the stations found, the following combinations may provide sufficient baseline data.\n\n")
-                                printed = True
-                                combo = 1
-                            print(">> Combination", combo, "at coordinates", coords['Latitude (Decimal Degrees)'][rw], \
-                                  coords['Longitude (Decimal Degrees)'][rw], "\n")
-                            for r in range(dups.shape[0]):
-                                print("Station {} : {} ({}-{})".format(
-                                  dups.iloc[[r]]['Station ID'].values[0],
-                                  dups.iloc[[r]].Name.values[0],
-                                  int(dups.iloc[[r]][wantcols[0]].values[0]),
-                                  int(dups.iloc[[r]][wantcols[1]].values[0])))
-                            print("\n")
-                            combo += 1
+            # Try to detect cases where the StationID has changed
+            with METRICS.timer("recodes"):
+                combos = find_recodes(period, type, stations=outside, tolerance=tolerance)
+            if combos.shape[0] > 0:
+                print("Note: In addition to the stations found, the following combinations may provide sufficient baseline data.\n\n")
+            for combo, dups in combos.groupby('Combination', sort=True):
+                print(">> Combination", combo, "at coordinates", dups['Latitude (Decimal Degrees)'].iloc[0],
+                      dups['Longitude (Decimal Degrees)'].iloc[0], "\n")
+                for station, stname, first, last in zip(dups['Station ID'], dups.Name, dups[wantcols[0]], dups[wantcols[1]]):
+                    print("Station {} : {} ({}-{})".format(station, stname, int(first), int(last)))
+                print("\n")
 
         if filt.shape[0] == 0:
             print("No results!")
@@ -245,7 +1363,165 @@ def find_station(name=None, province=None, period=None, type=None, detect_recode
     return filt
 
 
-def get_data(stations=None, type=2, years=None, months=range(1,13), progress=True):
+def parse_type(type):
+    if not type in [1, 2, 3]:
+        if not re.search('1|H|h|2|D|d|3|M|m', type):
+            raise Exception("Invalid type passed.")
+        elif type[0] in ['1', 'h', 'H']:
+            type = 1
+        elif type[0] in ['2', "d", 'D']:
+            type = 2
+        else:
+            type = 3
+    return type
+
+
+def combine_files(files):
+    """Concatenate parsed files, keeping the station metadata of each file
+    in attrs['stations'], by station code
+
+    Categorical columns are given the categories of all of the files, since
+    pd.concat would otherwise fall back to object for them.
+    """
+    chunks = list(files)
+    start = monotonic()
+    meta = {}
+    for chunk in chunks:
+        meta.setdefault(chunk.attrs['metadata']['station'], chunk.attrs['metadata'])
+        chunk.attrs = {}
+    for col in chunks[0].columns if chunks else []:
+        if all(col in chunk.columns and isinstance(chunk[col].dtype, pd.CategoricalDtype) for chunk in chunks):
+            categories = chunks[0][col].cat.categories
+            for chunk in chunks[1:]:
+                categories = categories.union(chunk[col].cat.categories)
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+    dat = pd.concat(chunks)
+    dat.attrs['stations'] = meta
+    METRICS.add_time("combine", monotonic() - start)
+    return dat
+
+
+AGGREGATES = ["mean", "min", "max", "sum", "count"]
+# The running totals that each aggregate is computed from, and how the
+# totals of two files are merged
+TOTALS = {"mean": ["sum", "count"], "min": ["min"], "max": ["max"], "sum": ["sum"], "count": ["count"]}
+MERGES = {"sum": "sum", "count": "sum", "min": "min", "max": "max"}
+
+
+def measurement_columns(columns):
+    """The columns of bulk data that hold measurements, in order"""
+    return [col for col, dtype in schema_dtypes(columns).items() if col != "Station" and dtype == 'float32']
+
+
+class Aggregator(object):
+    """Resample bulk data by station as it is downloaded
+
+    Each file added is folded into running totals (sums, counts, minima
+    and maxima) for each station and period, so that only the totals are
+    held in memory, however many files there are. Periods that span more
+    than one file, e.g. a day of hourly data resampled weekly, are merged
+    across them.
+
+    Optional Parameters
+    ----------
+    freq : str
+        The period to resample to, as a pandas offset alias, e.g. "D" for
+        days, "MS" for months or "YS" for years; Default: "D".
+    agg : str or list
+        Aggregates to compute for each period, separated by commas or as
+        a list. Options: mean, min, max, sum, count; Default: "mean".
+    columns : list
+        Columns to aggregate; Default: every measurement column.
+
+    Periods are labelled by their start (or end, for offsets such as "ME"
+    that are anchored to it), and multiples of fixed periods, e.g. "6h",
+    start from the Unix epoch. The aggregates of a column are in columns
+    named after it and the aggregate, e.g. "Temp (°C) mean".
+    """
+
+    max_partials = 64
+
+    def __init__(self, freq="D", agg="mean", columns=None):
+        try:
+            offset = pd.tseries.frequencies.to_offset(freq)
+        except ValueError:
+            raise Exception("Invalid resampling frequency: {}".format(freq))
+        # Fixed periods start from the same time in every file, rather than the first row of each
+        self.origin = 'epoch' if isinstance(offset, pd.offsets.Tick) else 'start_day'
+        if isinstance(agg, str):
+            agg = agg.split(",")
+        agg = [x.strip() for x in agg]
+        unknown = [x for x in agg if x not in AGGREGATES]
+        if unknown:
+            raise Exception("Unknown aggregate(s): {}. Options are: {}".format(
+              ", ".join(unknown), ", ".join(AGGREGATES)))
+        self.freq = freq
+        self.agg = agg
+        self.columns = columns
+        self.totals = [total for total in MERGES if any(total in TOTALS[x] for x in agg)]
+        self.partials = []
+        self.datecol = None
+        self.meta = {}
+
+    def add(self, dat):
+        """Fold a parsed file, with the columns typed by apply_schema, into
+        the running totals"""
+        with METRICS.timer("aggregate"):
+            if 'metadata' in dat.attrs:
+                self.meta.setdefault(dat.attrs['metadata']['station'], dat.attrs['metadata'])
+            datecol = [col for col in dat.columns if col.startswith("Date/Time")][0]
+            if self.columns is None:
+                self.columns = measurement_columns(dat.columns)
+            missing = [col for col in self.columns if col not in dat.columns]
+            if missing:
+                raise Exception("Column(s) not in the data: {}".format(", ".join(missing)))
+            self.datecol = datecol
+            values = dat[self.columns].astype('float64').assign(Station=dat["Station"], **{datecol: dat[datecol]})
+            groups = values.groupby(["Station", pd.Grouper(key=datecol, freq=self.freq, origin=self.origin)],
+                                    sort=False)
+            self.partials.append(pd.concat({total: self.total(groups, total) for total in self.totals}, axis=1))
+            if len(self.partials) > self.max_partials:
+                self.partials = [self.collapse()]
+
+    def total(self, groups, total):
+        if total == "sum":
+            # Periods without any values have no sum, rather than a sum of 0
+            return groups.sum(min_count=1)
+        return getattr(groups, total)()
+
+    def collapse(self):
+        """Merge the totals of the files added so far"""
+        dat = pd.concat(self.partials)
+        return pd.concat({total: self.total(dat[total].groupby(level=[0, 1], sort=False), MERGES[total])
+                          for total in self.totals}, axis=1)
+
+    def result(self):
+        """The aggregates of the files added so far, with a row for each
+        station and period, in the order in which they were added"""
+        if not self.partials:
+            raise Exception("No data to aggregate.")
+        with METRICS.timer("aggregate"):
+            totals = self.collapse()
+            self.partials = [totals]
+            out = {}
+            for col in self.columns:
+                for agg in self.agg:
+                    if agg == "mean":
+                        values = totals["sum"][col] / totals["count"][col].where(totals["count"][col] > 0)
+                    elif agg in ["min", "max"]:
+                        # Like the measurements themselves
+                        values = totals[agg][col].astype('float32')
+                    else:
+                        values = totals[agg][col]
+                    out["{} {}".format(col, agg)] = values
+            dat = pd.DataFrame(out, index=totals.index).reset_index()
+            dat.attrs['stations'] = self.meta
+            return dat
+
+
+def get_data(stations=None, type=2, years=None, months=range(1,13), progress=True, workers=1, max_rps=4,
+             cache=True, typed=False, retries=RETRIES, checkpoint=None, parsers=1, aggregate=None):
     """Download data from the Environment and Climate Change Canada
     historical data archive
 
@@ -262,19 +1538,79 @@ def get_data(stations=None, type=2, years=None, months=range(1,13), progress=Tru
         Range of months for which to download data (only applies to hourly)
     progress : Boolean
         Whether to show the progress bar.
+    workers : int
+        Number of files to download concurrently; Default: 1.
+    max_rps : float
+        Maximum number of requests per second across all workers; Default: 4.
+        Pass None to disable rate limiting.
+    cache : Boolean or Cache
+        Whether to use the download cache in EC3_CACHE_DIR, or a Cache
+        object to use instead; Default: True.
+    typed : Boolean
+        Whether to convert the columns to fixed types (see apply_schema)
+        rather than the types inferred by pd.read_csv; Default: False.
+    retries : int
+        Number of times to retry a failed download; Default: 5.
+    checkpoint : str
+        Directory in which to keep the downloaded files that the cache
+        does not keep (those of periods that have not ended, or all of them
+        with cache=False) until the job is done. If a job is interrupted,
+        passing the same directory again resumes it without downloading
+        those files again.
+    parsers : int
+        Number of processes to parse the files with. Worthwhile for large
+        hourly downloads, where parsing rather than downloading is the
+        bottleneck; Default: 1, parse in this process. The processes import
+        the calling script again, so a script passing parsers > 1 must call
+        ec3 from under `if __name__ == "__main__":`.
+    aggregate : dict
+        Resample the data of each station instead of returning every row,
+        e.g. {"freq": "D", "agg": ["mean", "max", "min"]} (see Aggregator
+        for the keys). Each file is aggregated as soon as it is parsed, so
+        only the aggregates are held in memory. typed is implied.
+
+    The station metadata from each file (name, coordinates, elevation and
+    identifiers) is kept in the attrs['stations'] of the result.
     """
 
-    tempdir = mkdtemp()
+    type = parse_type(type)
+    if aggregate is not None:
+        aggregator = Aggregator(**aggregate)
+        for dat in iter_data(stations=stations, type=type, years=years, months=months, progress=progress,
+                             workers=workers, max_rps=max_rps, cache=cache, typed=True, retries=retries,
+                             checkpoint=checkpoint, parsers=parsers):
+            aggregator.add(dat)
+        return aggregator.result()
+    # In one process, converting the columns once the files are combined is
+    # quicker; with more parsers, each converts the files that it parses.
+    per_file = typed and parsers > 1
+    dat = combine_files(iter_data(stations=stations, type=type, years=years, months=months,
+                                  progress=progress, workers=workers, max_rps=max_rps, cache=cache,
+                                  typed=per_file, retries=retries, checkpoint=checkpoint, parsers=parsers))
+    return apply_schema(dat, type) if typed and not per_file else dat
+
+
+def iter_data(stations=None, type=2, years=None, months=range(1,13), progress=True, workers=1, max_rps=4,
+              cache=True, typed=False, retries=RETRIES, checkpoint=None, parsers=1):
+    """Download data from the Environment and Climate Change Canada
+    historical data archive, one file at a time
+
+    Takes the same parameters as get_data(), but yields a DataFrame for
+    each downloaded file, in request order, instead of combining them. Only
+    one file is parsed and held in memory at a time. The station metadata
+    of each file is kept in its attrs['metadata']. As for get_data(), a
+    script passing parsers > 1 must call ec3 from under
+    `if __name__ == "__main__":`.
+    """
+
+    stations, type, years, months = parse_request(stations, type, years, months)
+    jobs = [(station, year, month) for station in stations for year in years for month in months]
+    return iter_files(jobs, type, progress=progress, workers=workers, max_rps=max_rps,
+                      cache=cache, typed=typed, retries=retries, checkpoint=checkpoint, parsers=parsers)
 
-    if not type in [1, 2, 3]:
-        if not re.search('1|H|h|2|D|d|3|M|m', type):
-            raise Exception("Invalid type passed.")
-        elif type[0] in ['1', 'h', 'H']:
-            type = 1
-        elif type[0] in ['2', "d", 'D']:
-            type = 2
-        else:
-            type = 3
+
+def parse_request(stations, type, years, months):
+    type = parse_type(type)
 
     if isinstance(stations, str) or not hasattr(stations, '__len__'):
         stations = [stations]
@@ -312,59 +1648,927 @@ def get_data(stations=None, type=2, years=None, months=range(1,13), progress=Tru
             except ValueError:
                 exit("One or more years could not be coerced to integer. Typo?")
 
-    loops = len(stations) * len(years) * len(months)
-    i = 0
-    if progress:
-        pbar = tqdm(total=loops, leave=False, unit="files")
+    return stations, type, years, months
 
-    for station in stations:
-        for year in years:
-            for month in months:
-                if type == 1:
-                    period = "hourly"
-                    filemth = "-{}".format(str(month).zfill(2))
-                    fileyr = "-{}".format(year)
-                elif type == 2:
-                    period = "daily"
-                    filemth = ""
-                    fileyr = "-{}".format(year)
-                elif type == 3:
-                    period = "monthly"
-                    filemth=""
-                    fileyr=""
-
-                url = "http://climate.weather.gc.ca/climate_data/bulk_data_e.html?format=csv&stationID={}&Year={}&Month={}&Day=14&timeframe={}&submit=Download+Data".format(station, year, month, type)
-                filename = os.path.join(tempdir, "{}-{}{}{}.csv".format(station, period, fileyr, filemth))
-                download_file(url, filename)
 
+def read_stores(stores, station, type, year, month):
+    """Text of a file from the first of the caches that has it, copied to
+    the caches before it"""
+    for i, store in enumerate(stores):
+        if store:
+            filename = store.get(station, type, year, month)
+            if filename is not None:
                 try:
-                    dat
-                except NameError:
-                    dat = pd.read_csv(filename, skiprows = guess_skip(filename)).assign(Station=station)
-                else:
-                    dat = dat.append(pd.read_csv(filename, skiprows = guess_skip(filename)).assign(Station=station))
+                    with METRICS.timer("cache_read"):
+                        with open(filename, 'r', encoding='utf-8') as file:
+                            text = file.read()
+                except OSError:
+                    # Removed since it was looked up, so it is a miss after all
+                    continue
+                METRICS.count("cache_hits")
+                write_stores(stores[:i], station, type, year, month, text)
+                return text
+    if any(stores):
+        METRICS.count("cache_misses")
+    return None
+
+
+def write_stores(stores, station, type, year, month, text):
+    if any(stores):
+        with METRICS.timer("cache_write"):
+            for store in stores:
+                if store:
+                    store.put(station, type, year, month, text)
+
+
+def parse_file(text, station, type, typed=False):
+    """Parse a downloaded file into a DataFrame with a Station column first
+    and the station metadata in attrs['metadata']"""
+    dat, meta = parse_bulk_data(text, type if typed else None)
+    dat = dat.assign(Station=station)
+    cols = dat.columns.tolist()
+    dat = dat[cols[-1:] + cols[:-1]]
+    meta['station'] = station
+    dat.attrs['metadata'] = meta
+    return dat
+
+
+def parse_in_worker(text, station, type, typed=False):
+    """parse_file() in a parser process, returning the timers and counters
+    of the parse (see Metrics) along with the data"""
+    METRICS.clear()
+    dat = parse_file(text, station, type, typed)
+    return dat, METRICS.snapshot()
+
+
+def iter_texts(jobs, type, workers=1, max_rps=4, cache=True, retries=RETRIES, checkpoint=None, errors="raise"):
+    """Download bulk data files for a list of (station, year, month) jobs,
+    yielding each job and the text of its file in order
+
+    With errors="yield", a file that cannot be downloaded is yielded as the
+    exception that stopped it, and the other files are still downloaded.
+    """
 
-                i = i + 1
-                
-                if progress:
-                    pbar.update(1)                
-                
-                if i != loops:
-                    sleep(0.25)
+    try:
+        workers = int(workers)
+    except ValueError:
+        exit("The number of workers could not be coerced to integer. Typo?")
+    if workers < 1:
+        raise Exception("At least one worker is required.")
+
+    session = make_session(workers)
+    limiter = RateLimiter(max_rps)
+    if cache is True:
+        cache = Cache()
+    if checkpoint is not None:
+        # Downloads that the cache will not keep are kept until the job is done
+        checkpoint = Cache(path=checkpoint, max_size=float('inf'), ttl=float('inf'))
+
+    def fetch(job):
+        station, year, month = job
+        end = period_end(type, year, month)
+        # Files of periods that have ended are resumed from the cache, rather than written twice
+        stores = [None if cache and end is not None and time() >= end else checkpoint, cache]
+        text = read_stores(stores, station, type, year, month)
+        if text is None:
+            text = fetch_text(bulk_url(station, year, month, type), session=session, retries=retries,
+                              limiter=limiter)
+            write_stores(stores, station, type, year, month, text)
+        return text
+
+    # Files are downloaded out of order, but always parsed in request order,
+    # so the output is the same no matter how many workers are used. Only a
+    # few files are downloaded ahead of the one being parsed, so that memory
+    # use stays bounded when downloads outpace parsing.
+    ahead = workers * 2
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch, job) for job in jobs[:ahead]]
+        try:
+            for i, job in enumerate(jobs):
+                try:
+                    text = futures[i].result()
+                except Exception as e:
+                    if errors != "yield":
+                        raise
+                    text = e
+                futures[i] = None
+                if i + ahead < len(jobs):
+                    futures.append(pool.submit(fetch, jobs[i + ahead]))
+                yield job, text
+                del text
+        except BaseException:
+            # Includes GeneratorExit, if the caller stops iterating early
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+            raise
+        finally:
+            session.close()
+
+    if cache:
+        cache.evict()
+
+
+def iter_files(jobs, type, progress=True, workers=1, max_rps=4, cache=True, typed=False, retries=RETRIES,
+               checkpoint=None, parsers=1, errors="raise"):
+    """Download and parse bulk data files for a list of (station, year,
+    month) jobs, yielding a DataFrame for each in order
+
+    With more than one parser, files are parsed in a pool of that many
+    processes, still yielded in order, while the next ones download. With
+    errors="yield", a file that cannot be downloaded or parsed is yielded
+    as the exception that stopped it instead of a DataFrame.
+    """
+
+    try:
+        parsers = int(parsers)
+    except ValueError:
+        exit("The number of parsers could not be coerced to integer. Typo?")
+
+    texts = iter_texts(jobs, type, workers=workers, max_rps=max_rps, cache=cache, retries=retries,
+                       checkpoint=checkpoint, errors=errors)
+    # Spawned rather than forked, since the download threads are already running
+    pool = ProcessPoolExecutor(max_workers=parsers, mp_context=get_context("spawn")) if parsers > 1 else None
+    pending = deque()
+
+    def collect(future):
+        if isinstance(future, Exception):
+            # A file that could not be downloaded
+            return future
+        try:
+            dat, snapshot = future.result()
+        except Exception as e:
+            if errors != "yield":
+                raise
+            return e
+        METRICS.merge(snapshot)
+        return dat
+
+    def parse_one(text, station):
+        if isinstance(text, Exception):
+            return text
+        try:
+            return parse_file(text, station, type, typed)
+        except Exception as e:
+            if errors != "yield":
+                raise
+            return e
+
+    def parse():
+        if pool is None:
+            for (station, year, month), text in texts:
+                yield parse_one(text, station)
+            return
+        # One file more than there are parsers is handed out, so that no parser waits for the next
+        for (station, year, month), text in texts:
+            if isinstance(text, Exception):
+                pending.append(text)
+            else:
+                pending.append(pool.submit(parse_in_worker, text, station, type, typed))
+            if len(pending) > parsers:
+                yield collect(pending.popleft())
+        while pending:
+            yield collect(pending.popleft())
 
     if progress:
-        pbar.close()
+        pbar = tqdm(total=len(jobs), leave=False, unit="files")
+    try:
+        for dat in parse():
+            if progress:
+                pbar.update(1)
+            yield dat
+    finally:
+        texts.close()
+        if pool is not None:
+            for future in pending:
+                if not isinstance(future, Exception):
+                    future.cancel()
+            pool.shutdown()
+        if progress:
+            pbar.close()
+
+
+def plan_chain(stations, type, years):
+    """Pick, for each year, the first station of a chain with data for it
+
+    Returns a list of (year, station) pairs in order of year. In a year
+    where the record of the first station starts or ends, it probably only
+    covers part of the year, so every station with data for that year is
+    picked, in chain order. Years that no station has data for are left out
+    with a warning. Monthly files hold the whole record of a station, so
+    every station is fetched once.
+    """
 
-    cols = dat.columns.tolist()
-    return dat[cols[-1:] + cols[:-1]]
+    if type == 3:
+        return [(year, station) for year in years for station in stations]
+
+    inv = get_inventory(behaviour="session")
+    first, last = year_columns(type)
+    records = inv.set_index('Station ID').reindex(stations)[[first, last]]
+    missing = [station for station, bad in zip(stations, (records[first].isnull() | records[last].isnull()).values) if bad]
+    if missing:
+        warnings.warn("No record in the inventory for station(s): {}".format(
+          ", ".join(str(x) for x in missing)))
+
+    plan = []
+    uncovered = []
+    for year in years:
+        covering = [(station, start, end) for station, start, end in zip(stations, records[first], records[last])
+                    if start <= year <= end]
+        if not covering:
+            uncovered.append(year)
+            continue
+        station, start, end = covering[0]
+        if start < year < end:
+            plan.append((year, station))
+        else:
+            plan.extend((year, station) for station, start, end in covering)
+    if uncovered:
+        warnings.warn("No station in the chain has data for year(s): {}".format(
+          ", ".join(str(x) for x in uncovered)))
+    return plan
+
+
+def get_chain(stations=None, type=2, years=None, months=range(1,13), progress=True, workers=1, max_rps=4,
+              cache=True, typed=False, retries=RETRIES, checkpoint=None, parsers=1):
+    """Download one continuous series from a chain of stations
+
+    Stations are often recoded over their lifetime (see find_recodes). For
+    each year, only the first station in stations with data for that year
+    (according to the inventory) is downloaded, along with the others in
+    the years where its record starts or ends (see plan_chain), and the
+    files are combined into one series. The Station column gives the source
+    of each row. Rows for the same date are only kept once, from the first
+    station in stations with any measurements for that date.
+
+    Takes the same parameters as get_data(), where stations is the chain in
+    order of preference.
+    """
+
+    stations, type, years, months = parse_request(stations, type, years, months)
+    jobs = [(station, year, month) for year, station in plan_chain(stations, type, years) for month in months]
+    if len(jobs) == 0:
+        raise Exception("None of the stations have data for the years requested.")
+    per_file = typed and parsers > 1
+    dat = combine_files(iter_files(jobs, type, progress=progress, workers=workers, max_rps=max_rps,
+                                   cache=cache, typed=per_file, retries=retries, checkpoint=checkpoint,
+                                   parsers=parsers))
+    datecol = [col for col in dat.columns if col.startswith("Date/Time")]
+    if datecol and dat.Station.nunique() > 1:
+        # Keep the preferred station with measurements first for each date,
+        # since files run to the end of the year after a station closes
+        rank = dat.Station.map({station: i for i, station in enumerate(stations)})
+        empty = dat[measurement_columns(dat.columns)].isnull().all(axis=1)
+        order = np.lexsort((np.arange(len(dat)), rank.values, empty.values, dat[datecol[0]].values))
+        dat = dat.iloc[order].drop_duplicates(subset=datecol[0], keep='first')
+    return apply_schema(dat, type) if typed and not per_file else dat
+
+
+def plan_requests(requests, behaviour="session"):
+    """Collapse a queue of requests into the unique files that they need
+
+    Each request is a dict of get_data() parameters (stations, type, years
+    and months); other keys are ignored. Files for years outside the record
+    of a station in the inventory are left out, since the archive would
+    return them empty. A record that ends in the latest year of the
+    inventory is taken to be still open. Stations that are not in the
+    inventory are kept as requested. Pass behaviour=None to skip the
+    inventory check.
+
+    Returns a dict with the unique (station, year, month) jobs of each type,
+    in order, and a list with the type, the jobs and, for a request left
+    with no jobs, an Exception saying why (otherwise None), of each request.
+    """
+
+    inv = None if behaviour is None else get_inventory(behaviour=behaviour)
+    records = {}
+    fetches = {}
+    plans = []
+    for request in requests:
+        stations, type, years, months = parse_request(request.get('stations'), request.get('type', 2),
+                                                      request.get('years'), request.get('months', range(1,13)))
+        jobs = [(station, year, month) for station in stations for year in years for month in months]
+        if inv is not None:
+            if type not in records:
+                first, last = year_columns(type)
+                # Stations still reporting have their last year as the year of the inventory
+                ends = inv[last].where(inv[last] != inv[last].max(), np.inf)
+                records[type] = dict(zip(inv['Station ID'], zip(inv[first], ends)))
+            keep = []
+            for job in jobs:
+                start, end = records[type].get(job[0], (-np.inf, np.inf))
+                # Monthly files hold the whole record, so only need a record at all
+                if (start <= job[1] <= end) if type != 3 else not (pd.isnull(start) or pd.isnull(end)):
+                    keep.append(job)
+            jobs = keep
+        error = None
+        if len(jobs) == 0:
+            if type == 3:
+                period = "monthly data"
+            elif len(years) > 1 and years == list(range(years[0], years[-1] + 1)):
+                period = "{}:{}".format(years[0], years[-1])
+            else:
+                period = ", ".join(str(x) for x in years)
+            error = Exception("There is no data in the inventory record of station(s) {} for {}.".format(
+              ", ".join(str(x) for x in stations), period))
+        plans.append((type, jobs, error))
+        fetches.setdefault(type, set()).update(jobs)
+    return {type: sorted(jobs) for type, jobs in fetches.items()}, plans
+
+
+def iter_batch(requests, progress=True, workers=1, max_rps=4, cache=True, typed=False, retries=RETRIES,
+               behaviour="session", parsers=1):
+    """Download the data for many requests at once, yielding the data of
+    each request as soon as its last file has arrived
+
+    Every file needed by the requests (see plan_requests) is downloaded
+    only once, however many requests share it, and is let go once every
+    request that needs it is done. Yields the position of each request in
+    requests and its data, as get_data() would return it. A request that
+    cannot be completed, e.g. because one of its files could not be
+    downloaded or the inventory has no data for it, gets the exception
+    instead, and the other requests carry on. A request can override
+    `typed`.
+    """
+
+    fetches, plans = plan_requests(requests, behaviour)
+    # The files that each request is still waiting for (None once it is
+    # done), the requests that need each file, and how many of them are
+    # not done yet
+    waiting = [set((type,) + job for job in jobs) for type, jobs, error in plans]
+    needs = {}
+    for i, keys in enumerate(waiting):
+        for key in keys:
+            needs.setdefault(key, []).append(i)
+    users = {key: len(positions) for key, positions in needs.items()}
+    files = {}
+
+    def done(i):
+        # Let go of the files that no other request still needs
+        for key in set((plans[i][0],) + job for job in plans[i][1]):
+            users[key] -= 1
+            if users[key] == 0:
+                files.pop(key, None)
+        waiting[i] = None
+
+    def finish(i):
+        type, jobs, error = plans[i]
+        try:
+            # combine_files clears the attrs of each file, so give it copies
+            dat = combine_files([files[(type,) + job].copy(deep=False) for job in jobs])
+            return apply_schema(dat, type) if requests[i].get('typed', typed) else dat
+        except Exception as e:
+            return e
+
+    for i, (type, jobs, error) in enumerate(plans):
+        if error is not None:
+            waiting[i] = None
+            yield i, error
+
+    for type, jobs in fetches.items():
+        for job, dat in zip(jobs, iter_files(jobs, type, progress=progress, workers=workers, max_rps=max_rps,
+                                             cache=cache, retries=retries, parsers=parsers, errors="yield")):
+            key = (type,) + job
+            if users[key] == 0:
+                # Every request that needed it has failed
+                continue
+            files[key] = dat
+            for i in needs[key]:
+                if waiting[i] is None:
+                    continue
+                if isinstance(dat, Exception):
+                    result = dat
+                else:
+                    waiting[i].discard(key)
+                    if waiting[i]:
+                        continue
+                    result = finish(i)
+                done(i)
+                yield i, result
+                del result
+
+
+def get_batch(requests, progress=True, workers=1, max_rps=4, cache=True, typed=False, retries=RETRIES,
+              behaviour="session", parsers=1):
+    """Download the data for many requests at once
+
+    Every file needed by the requests (see plan_requests) is downloaded
+    only once, however many requests share it. Returns a list with the data
+    for each request, as get_data() would return it. A request can override
+    `typed`. Raises the first error of any request, including a request
+    that the inventory has no data for; see iter_batch to carry on instead.
+    """
+
+    results = [None] * len(requests)
+    for i, dat in iter_batch(requests, progress=progress, workers=workers, max_rps=max_rps, cache=cache,
+                             typed=typed, retries=retries, behaviour=behaviour, parsers=parsers):
+        if isinstance(dat, Exception):
+            raise dat
+        results[i] = dat
+    return results
+
+
+def read_job(filename):
+    """Read a batch job: a JSON file with the get_data() parameters of a
+    request, the outfile to save its data to and, optionally, its format
+
+    Years and months can be given as colon-separated ranges, as on the
+    command line. A relative outfile is taken from the directory of the job.
+    """
+    with open(filename, 'r', encoding='utf-8') as file:
+        job = json.load(file)
+    if not isinstance(job, dict) or 'stations' not in job or 'outfile' not in job:
+        raise Exception("The job in {} needs stations and an outfile.".format(filename))
+    job.setdefault('format', "csv")
+    if job['format'] not in OUTPUT_FORMATS:
+        raise Exception("Invalid output format in {}. Options are: {}".format(filename, ", ".join(OUTPUT_FORMATS)))
+    stations = job['stations'] if isinstance(job['stations'], list) else [job['stations']]
+    try:
+        job['stations'] = [int(x) for x in stations]
+        for key in ['years', 'months']:
+            if isinstance(job.get(key), str):
+                ends = [int(x) for x in job[key].split(":")]
+                job[key] = range(min(ends), max(ends) + 1)
+        job['type'] = parse_type(job.get('type', 2))
+    except ValueError:
+        raise Exception("The stations, years or months in {} are not numbers. Typo?".format(filename))
+    job['typed'] = job['format'] != "csv"
+    job['outfile'] = os.path.join(os.path.dirname(filename), job['outfile'])
+    return job
+
+
+def run_jobs(jobs, **kwargs):
+    """Download a list of jobs (see read_job) together, and save the data of
+    each to its outfile as soon as it is complete. Takes the parameters of
+    get_batch().
+
+    Returns a list with None for each job that was saved, or the exception
+    that stopped it. A failed job does not stop the others.
+    """
+    errors = [None] * len(jobs)
+    for i, dat in iter_batch(jobs, **kwargs):
+        job = jobs[i]
+        if isinstance(dat, Exception):
+            errors[i] = dat
+            continue
+        try:
+            if job['format'] == "parquet" and os.path.isdir(job['outfile']):
+                shutil.rmtree(job['outfile'])
+            partition_cols = ["Station", "Year"] if job['format'] == "parquet" and job['type'] == 1 else None
+            write_output(dat, job['outfile'], job['format'], partition_cols)
+        except ImportError:
+            errors[i] = Exception("Writing {} files requires pyarrow.".format(job['format']))
+        except Exception as e:
+            errors[i] = e
+        del dat
+    return errors
+
+
+def watch_jobs(directory, interval=5, **kwargs):
+    """Run the jobs saved to a directory as they arrive, until interrupted
+
+    All of the jobs found at each look are downloaded together (see
+    run_jobs). Each job file is then renamed to .done, or to .failed if it
+    could not be read, downloaded or saved. The inventory used to plan the
+    jobs is read again once it is older than INVENTORY_TTL seconds, so that
+    a long-running watch sees the new years of each station.
+    """
+    loaded = monotonic()
+    while True:
+        jobs = []
+        names = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".json"):
+                continue
+            filename = os.path.join(directory, name)
+            try:
+                jobs.append(read_job(filename))
+                names.append(filename)
+            except Exception as e:
+                print("Failed:", name, e)
+                os.replace(filename, filename + ".failed")
+        if jobs:
+            if monotonic() - loaded > INVENTORY_TTL:
+                clear_inventory()
+                loaded = monotonic()
+            try:
+                errors = run_jobs(jobs, **kwargs)
+            except Exception as e:
+                # e.g. the inventory could not be downloaded to plan the jobs
+                errors = [e] * len(jobs)
+            for filename, error in zip(names, errors):
+                if error is None:
+                    print("Done:", os.path.basename(filename))
+                    os.replace(filename, filename + ".done")
+                else:
+                    print("Failed:", os.path.basename(filename), error)
+                    os.replace(filename, filename + ".failed")
+        sleep(interval)
+
+
+def make_async_session(workers=1):
+    # Imported here rather than with ec3, since only the asynchronous functions need it
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError("The asynchronous functions require aiohttp.")
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max(workers, 1)),
+                                 timeout=aiohttp.ClientTimeout(total=TIMEOUT))
+
+
+async def afetch_text(url, session, retries=RETRIES, backoff=None, limiter=None):
+    """Download a file and return its text without blocking the event loop
+
+    Failed downloads are retried, and rate limited, like in fetch_text().
+    `session` is an aiohttp.ClientSession.
+    """
+    if backoff is None:
+        backoff = BACKOFF
+    for attempt in range(retries + 1):
+        retry_after = None
+        if limiter is not None:
+            wait = limiter.reserve()
+            if wait > 0:
+                METRICS.add_time("rate_limit", wait)
+                await asyncio.sleep(wait)
+        if DEBUG:
+            print("Downloading", url, "" if attempt == 0 else "(attempt {})".format(attempt + 1))
+        METRICS.count("requests")
+        try:
+            with METRICS.timer("download"):
+                async with session.get(url) as r:
+                    status = r.status
+                    retry_after = r.headers.get('Retry-After')
+                    content = await r.read()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = "The error was: {}".format(e)
+        else:
+            METRICS.count("bytes", len(content))
+            with METRICS.timer("decode"):
+                text = content.decode('utf-8', errors='replace')
+            error = response_error(status, text)
+            if error is None:
+                return text
+        if attempt < retries:
+            METRICS.count("retries")
+            wait = retry_delay(attempt, backoff, retry_after)
+            METRICS.add_time("retry_wait", wait)
+            await asyncio.sleep(wait)
+    raise DownloadError("There was an error downloading that file after {} attempts! {}".format(retries + 1, error))
+
+
+def save_text(filename, text):
+    # Written next to its final name first, so that readers never see half a file
+    fd, temp = mkstemp(dir=os.path.dirname(filename) or ".", suffix=".part")
+    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+        file.write(text)
+    os.replace(temp, filename)
+
+
+async def aget_inventory(behaviour="session", session=None):
+    """Get the station inventory without blocking the event loop
+
+    Takes the same behaviours as get_inventory(). The inventory is
+    downloaded with aiohttp, optionally with an existing
+    aiohttp.ClientSession, and read in a worker thread. A missing local
+    inventory raises an Exception instead of exiting.
+    """
+    loop = asyncio.get_running_loop()
+    filename = INVENTORY_FILE
+    if behaviour not in ["local", "session", "update"]:
+        raise Exception("Unknown behaviour passed.")
+    if behaviour == "local" and not os.path.isfile(filename):
+        raise Exception("Cannot find the station inventory in the current working directory. " + \
+                        "Please run \"ec3 inv\" to download it.")
+    if behaviour == "session" and not os.path.isfile(filename):
+        # Downloaded once per process, then loaded like any other copy
+        filename = os.path.join(gettempdir(), "ec3-{}".format(os.getpid()), INVENTORY_FILE)
+    if behaviour == "update" or not os.path.isfile(filename):
+        own_session = session is None
+        if own_session:
+            session = make_async_session()
+        try:
+            text = await afetch_text(INVENTORY_URL, session)
+        finally:
+            if own_session:
+                await session.close()
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        await loop.run_in_executor(None, save_text, filename, text)
+    if behaviour == "update":
+        load_inventory.cache_clear()
+        return await loop.run_in_executor(None, compile_inventory, filename)
+    return await loop.run_in_executor(None, load_inventory, os.path.abspath(filename))
+
+
+async def aiter_files(jobs, type, workers=1, max_rps=4, cache=True, typed=False, retries=RETRIES, session=None):
+    """Asynchronous version of iter_files()
+
+    At most `workers` files are downloaded at a time. Cache lookups and
+    parsing run in worker threads, so the event loop is never blocked for
+    long. If the caller stops iterating, or the task is cancelled, the
+    pending downloads are cancelled too.
+    """
+
+    if workers < 1:
+        raise Exception("At least one worker is required.")
+
+    loop = asyncio.get_running_loop()
+    own_session = session is None
+    if own_session:
+        session = make_async_session(workers)
+    limiter = RateLimiter(max_rps)
+    semaphore = asyncio.Semaphore(workers)
+    if cache is True:
+        cache = Cache()
+    stores = [cache]
+
+    async def fetch(job):
+        station, year, month = job
+        async with semaphore:
+            text = await loop.run_in_executor(None, read_stores, stores, station, type, year, month)
+            if text is None:
+                text = await afetch_text(bulk_url(station, year, month, type), session, retries=retries,
+                                         limiter=limiter)
+                await loop.run_in_executor(None, write_stores, stores, station, type, year, month, text)
+        return text
+
+    # The same window of downloads ahead of the parser as in iter_files()
+    ahead = workers * 2
+    tasks = [asyncio.ensure_future(fetch(job)) for job in jobs[:ahead]]
+    try:
+        for i, (station, year, month) in enumerate(jobs):
+            text = await tasks[i]
+            tasks[i] = None
+            if i + ahead < len(jobs):
+                tasks.append(asyncio.ensure_future(fetch(jobs[i + ahead])))
+            dat = await loop.run_in_executor(None, parse_file, text, station, type, typed)
+            del text
+            yield dat
+    finally:
+        pending = [task for task in tasks if task is not None]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        if own_session:
+            await session.close()
+
+    if cache:
+        await loop.run_in_executor(None, cache.evict)
+
+
+async def aiter_data(stations=None, type=2, years=None, months=range(1,13), workers=1, max_rps=4, cache=True,
+                     typed=False, retries=RETRIES, session=None):
+    """Download data without blocking the event loop, one file at a time
+
+    Takes the same parameters as iter_data(), except for progress, and
+    yields a DataFrame for each file in request order. Requires aiohttp.
+    To stop early, close the generator (e.g. with aclose()), which cancels
+    the pending downloads and closes the session it created.
+
+    Optional Parameters
+    ----------
+    session : aiohttp.ClientSession
+        A session to download with, e.g. to share one connection pool
+        across requests. Default: a new session for this request.
+    """
+
+    stations, type, years, months = parse_request(stations, type, years, months)
+    jobs = [(station, year, month) for station in stations for year in years for month in months]
+    files = aiter_files(jobs, type, workers=workers, max_rps=max_rps, cache=cache, typed=typed,
+                        retries=retries, session=session)
+    try:
+        async for dat in files:
+            yield dat
+    finally:
+        # async for does not close files if we stop early, so the pending
+        # downloads would carry on until it is garbage collected
+        await files.aclose()
+
+
+async def aget_data(stations=None, type=2, years=None, months=range(1,13), workers=1, max_rps=4, cache=True,
+                    typed=False, retries=RETRIES, session=None, aggregate=None):
+    """Download data without blocking the event loop
+
+    Takes the same parameters as aiter_data(), and returns the data
+    combined like get_data(), or resampled if aggregate is given (see
+    get_data). Requires aiohttp.
+    """
+
+    type = parse_type(type)
+    loop = asyncio.get_running_loop()
+    if aggregate is not None:
+        aggregator = Aggregator(**aggregate)
+        files = aiter_data(stations=stations, type=type, years=years, months=months, workers=workers,
+                           max_rps=max_rps, cache=cache, typed=True, retries=retries, session=session)
+        try:
+            async for dat in files:
+                await loop.run_in_executor(None, aggregator.add, dat)
+        finally:
+            await files.aclose()
+        return await loop.run_in_executor(None, aggregator.result)
+    files = [dat async for dat in aiter_data(stations=stations, type=type, years=years, months=months,
+                                             workers=workers, max_rps=max_rps, cache=cache,
+                                             retries=retries, session=session)]
+    dat = await loop.run_in_executor(None, combine_files, files)
+    if typed:
+        dat = await loop.run_in_executor(None, apply_schema, dat, type)
+    return dat
+
+
+def period_key(year, month, type):
+    if type == 1:
+        return "{}-{}".format(year, str(month).zfill(2))
+    elif type == 2:
+        return str(year)
+    return "all"
+
+
+def load_manifest(store):
+    try:
+        with open(os.path.join(store, "manifest.json"), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(store, manifest):
+    filename = os.path.join(store, "manifest.json")
+    with open(filename + ".part", 'w', encoding='utf-8') as file:
+        json.dump(manifest, file)
+    os.replace(filename + ".part", filename)
+
+
+def store_filename(store, type, station, year, month, format):
+    timeframe = ['hourly', 'daily', 'monthly'][type - 1]
+    return os.path.join(store, timeframe, str(station),
+                        os.path.splitext(bulk_filename(station, year, month, type))[0] + "." + format)
+
+
+def sync_periods(type, first, last, now):
+    """All periods of a record from first to last year that have begun by now"""
+    if type == 3:
+        return [(1989, 6)]
+    today = datetime.fromtimestamp(now)
+    periods = []
+    for year in range(first, min(last, today.year) + 1):
+        if type == 2:
+            periods.append((year, 6))
+        else:
+            periods += [(year, month) for month in range(1, 13)
+                        if (year, month) <= (today.year, today.month)]
+    return periods
+
+
+def dir_mtime(path):
+    """Modification time of a directory in ns, which changes whenever a file
+    in it is added, renamed or deleted, or None if it does not exist"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def sync_closed(type, year, month, fetched, last):
+    """Whether a file downloaded at fetched can no longer change"""
+    if fetched is None:
+        return False
+    # A station's files also stop changing once its record has ended
+    end = period_end(type, year, month)
+    return fetched >= datetime(last + 1, 1, 1).timestamp() or (end is not None and fetched >= end)
+
+
+def sync(store, stations=None, type=2, years=None, progress=True, workers=1, max_rps=4, cache=True,
+         format="csv", retries=RETRIES, parsers=1):
+    """Update a local store of data, downloading only what it is missing
+
+    The store keeps one file per downloaded file (station and year, or
+    station, year and month for hourly data), under <store>/<timeframe>/
+    <station>/. A manifest records when each file was downloaded. Files are
+    downloaded again only if their period (or the station's record in the
+    inventory) had not ended when they were last downloaded, or if they are
+    missing from the store. Stations whose record has not changed in the
+    inventory since they were last completed are skipped, unless files have
+    been deleted from their directory since (which changes its
+    modification time), in which case only the missing files are
+    downloaded.
+
+    Parameters
+    ----------
+    store : str
+        Directory in which to keep the data.
+
+    Optional Parameters
+    ----------
+    stations : int or list
+        One or more station codes to keep up to date.
+    type : int or str
+        The type of data to keep: 1, hourly; 2, daily; 3, monthly
+    years : int or range
+        Range of years to keep; Default: the years in the inventory.
+    format : str
+        Format of the files in the store: csv, parquet or feather.
+
+    The other parameters are the same as for get_data(). Returns the number
+    of files downloaded.
+    """
+
+    type = parse_type(type)
+    if format not in OUTPUT_FORMATS:
+        raise Exception("Unknown output format.")
+    if isinstance(stations, str) or not hasattr(stations, '__len__'):
+        stations = [stations]
+    stations = [int(x) for x in stations]
+    if years is not None and not hasattr(years, '__len__'):
+        years = [years]
+
+    inv = get_inventory(behaviour="session")
+    records = inv.set_index('Station ID').reindex(stations)[year_columns(type)]
+    timeframe = ['hourly', 'daily', 'monthly'][type - 1]
+    manifest = load_manifest(store)
+    # Files count as downloaded at the start, in case a period ends mid-sync
+    now = time()
+
+    jobs = []
+    for station, first, last in zip(stations, records.iloc[:, 0], records.iloc[:, 1]):
+        if np.isnan(first) or np.isnan(last):
+            warnings.warn("No {} record in the inventory for station {}.".format(timeframe, station))
+            continue
+        first, last = int(first), int(last)
+        if years is not None:
+            first, last = max(first, min(years)), min(last, max(years))
+        entry = manifest.setdefault("{}/{}".format(timeframe, station), {'periods': {}})
+        if entry.get('record') == [first, last] and entry.get('complete') and \
+          entry.get('mtime') == dir_mtime(os.path.join(store, timeframe, str(station))):
+            continue
+        periods = sync_periods(type, first, last, now)
+        # Files deleted from the store are downloaded again
+        present = [os.path.exists(store_filename(store, type, station, year, month, format))
+                   for year, month in periods]
+        if entry.get('record') == [first, last] and entry.get('complete') and all(present):
+            entry['mtime'] = dir_mtime(os.path.join(store, timeframe, str(station)))
+            continue
+        entry['record'] = [first, last]
+        entry['complete'] = False
+        for (year, month), exists in zip(periods, present):
+            if not exists or not sync_closed(type, year, month, entry['periods'].get(period_key(year, month, type)),
+                                             last):
+                jobs.append((station, year, month))
+
+    def finish(station):
+        # Once every file of a station has stopped changing, and no more
+        # can appear, later syncs can skip it
+        entry = manifest["{}/{}".format(timeframe, station)]
+        first, last = entry['record']
+        entry['complete'] = datetime.fromtimestamp(now).year > last and all(
+          sync_closed(type, year, month, entry['periods'].get(period_key(year, month, type)), last)
+          for year, month in sync_periods(type, first, last, now))
+        # Lets the next sync skip the station with one stat, if no file has been deleted since
+        entry['mtime'] = dir_mtime(os.path.join(store, timeframe, str(station))) if entry['complete'] else None
+
+    os.makedirs(store, exist_ok=True)
+    files = iter_files(jobs, type, progress=progress, workers=workers, max_rps=max_rps,
+                       cache=cache, typed=(format != "csv"), retries=retries, parsers=parsers)
+    current = None
+    for (station, year, month), dat in zip(jobs, files):
+        if station != current and current is not None:
+            # Save progress after each station, so an interrupted sync can pick up from there
+            finish(current)
+            save_manifest(store, manifest)
+        current = station
+        filename = store_filename(store, type, station, year, month, format)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # Written next to its final name first, so that readers never see half a file
+        write_output(dat, filename + ".part", format)
+        os.replace(filename + ".part", filename)
+        manifest["{}/{}".format(timeframe, station)]['periods'][period_key(year, month, type)] = now
+
+    for station in stations:
+        entry = manifest.get("{}/{}".format(timeframe, station))
+        if entry is not None and 'record' in entry and not entry['complete']:
+            finish(station)
+    save_manifest(store, manifest)
+    return len(jobs)
 
 
 if __name__ == '__main__':
+    # Parser processes of a frozen (PyInstaller) ec3 would otherwise run the command again
+    freeze_support()
     arguments = docopt(__doc__, version = "ec3 " + __version__)
 
     if DEBUG:
         print(arguments)
 
+    if arguments['--trace'] is not None:
+        events = []
+        METRICS.hooks.append(lambda kind, name, value: events.append(
+          {'time': monotonic() - METRICS.started, 'kind': kind, 'name': name, 'value': value}))
+        atexit.register(save_trace, arguments['--trace'], events)
+    if arguments['--stats']:
+        atexit.register(lambda: print(format_stats(METRICS.summary())))
+
     if arguments['find']:
 
         null = get_inventory(behaviour="local")
@@ -406,16 +2610,53 @@ if __name__ == '__main__':
         else:
             dist = None
 
+        if arguments['--targets-file'] is not None:
+            try:
+                targets = pd.read_csv(arguments['--targets-file'], index_col=0)
+            except (OSError, ValueError) as e:
+                exit("Could not read the targets file: {}".format(e))
+            try:
+                # Longitudes are given in degrees W, like --target
+                targets = targets.assign(**{targets.columns[1]: -targets.iloc[:, 1].astype(float)})
+            except (IndexError, ValueError):
+                exit("The targets file needs latitude and longitude columns after the identifier.")
+            try:
+                k = int(arguments['--nearest'])
+            except ValueError:
+                exit("The number of nearest stations could not be coerced to integer. Typo?")
+            if min(dist) > 0:
+                exit("A minimum --dist cannot be used with --targets-file, only a maximum, e.g. 0:50")
+            results = nearest_stations(targets, k=k, max_dist=max(dist),
+                                       type=arguments['--type'], period=period)
+            if results.shape[0] == 0:
+                print("No results!")
+                exit(0)
+            if arguments['--outfile'] is not None:
+                try:
+                    write_output(results, arguments['--outfile'], arguments['--format'])
+                except ImportError:
+                    exit("Writing {} files requires pyarrow.".format(arguments['--format']))
+            print(results)
+            exit(0)
+
+        try:
+            tolerance = float(arguments['--tolerance'])
+        except ValueError:
+            exit("Tolerance could not be coerced to a number. Typo?")
+
         province = None if len(arguments['--prov']) == 0 else arguments['--prov']
 
         results = find_station(name=arguments['--name'], province=province,
                                period=period, type=arguments['--type'],
                                detect_recodes=arguments['--recodes'],
-                               target=target, dist=dist)
+                               target=target, dist=dist, tolerance=tolerance)
 
         if results is not None:
             if arguments['--outfile'] is not None:
-                results.to_csv(arguments['--outfile'], index=False)
+                try:
+                    write_output(results, arguments['--outfile'], arguments['--format'])
+                except ImportError:
+                    exit("Writing {} files requires pyarrow.".format(arguments['--format']))
             print(results)
 
         exit(0)
@@ -476,18 +2717,181 @@ if __name__ == '__main__':
                     years = [int(x) for x in arguments['-y'].split(":")]
                     years = range(min(years), max(years) + 1)
 
-        OUT = get_data(stations=stations, type=timeframe,
-                       years=years, months=months,
-                       progress=(not arguments['--noprogress']))
+        try:
+            workers = int(arguments['--workers'])
+        except ValueError:
+            exit("The number of workers could not be coerced to integer. Typo?")
+
+        try:
+            max_rps = float(arguments['--max-rps'])
+        except ValueError:
+            exit("The maximum request rate could not be coerced to a number. Typo?")
+
+        try:
+            retries = int(arguments['--retries'])
+        except ValueError:
+            exit("The number of retries could not be coerced to integer. Typo?")
+
+        try:
+            parsers = int(arguments['--parsers'])
+        except ValueError:
+            exit("The number of parsers could not be coerced to integer. Typo?")
+
+        fmt = arguments['--format']
+        if fmt not in OUTPUT_FORMATS:
+            exit("Invalid output format. Options are: " + ", ".join(OUTPUT_FORMATS))
+        if fmt == "feather" and arguments['--stream']:
+            exit("Feather output cannot be streamed.")
+        if arguments['--chain'] and arguments['--stream']:
+            exit("Chained stations cannot be streamed.")
+
+        aggregate = None
+        if arguments['--resample'] is not None:
+            if arguments['--chain'] or arguments['--stream']:
+                exit("Resampled data cannot be chained or streamed.")
+            aggregate = dict(freq=arguments['--resample'], agg=arguments['--agg'])
+            try:
+                Aggregator(**aggregate)
+            except Exception as e:
+                exit(str(e))
 
         if arguments['--outfile'] is not None:
             outfile = arguments['--outfile']
         else:
-            outfile = "{}-{}-{}{}.csv".format(
+            outfile = "{}-{}-{}{}.{}".format(
               arguments['-s'] if isinstance(arguments['-s'], str) else '+'.join(arguments['-s']),
               ['hourly', 'daily', 'monthly'][timeframe - 1],
               re.sub(':', '-', arguments['-y']),
-              '' if timeframe != 1 or arguments['-s'] is None else '-m' + re.sub(':', '-', arguments['-m']))
-        print("Saving data to", outfile)
-        OUT.to_csv(outfile, index=False)
+              '' if timeframe != 1 or arguments['-s'] is None else '-m' + re.sub(':', '-', arguments['-m']),
+              fmt)
+
+        request = dict(stations=stations, type=timeframe,
+                       years=years, months=months,
+                       progress=(not arguments['--noprogress']),
+                       workers=workers, max_rps=max_rps,
+                       cache=(not arguments['--nocache']),
+                       typed=(fmt != "csv"),
+                       retries=retries,
+                       checkpoint=outfile + ".partial",
+                       parsers=parsers)
+
+        if not arguments['--resume'] and os.path.isdir(request['checkpoint']):
+            shutil.rmtree(request['checkpoint'])
+        if fmt == "parquet" and os.path.isdir(outfile):
+            # Partitioned output would otherwise be added to the old files
+            shutil.rmtree(outfile)
+
+        try:
+            if arguments['--stream']:
+                partition_cols = None if fmt == "csv" else ["Station", "Year"]
+                print("Saving data to", outfile)
+                cols = None
+                for chunk in iter_data(**request):
+                    if cols is None:
+                        cols = chunk.columns
+                        write_output(chunk, outfile, fmt, partition_cols)
+                    else:
+                        write_output(chunk.reindex(columns=cols), outfile, fmt, partition_cols, append=True)
+            else:
+                partitioned = fmt == "parquet" and timeframe == 1 and aggregate is None
+                partition_cols = ["Station", "Year"] if partitioned else None
+                OUT = get_chain(**request) if arguments['--chain'] else get_data(aggregate=aggregate, **request)
+                print("Saving data to", outfile)
+                write_output(OUT, outfile, fmt, partition_cols)
+        except ImportError:
+            exit("Writing {} files requires pyarrow.".format(fmt))
+        except (DownloadError, KeyboardInterrupt) as e:
+            print(e)
+            exit("The download was interrupted. Run the same command with --resume to continue.")
+        shutil.rmtree(request['checkpoint'], ignore_errors=True)
+        exit(0)
+
+    if arguments['sync']:
+
+        try:
+            stations = [int(x) for x in arguments['-s']]
+        except ValueError:
+            exit("One or more stations could not be coerced to integer. Typo?")
+
+        try:
+            timeframe = parse_type(arguments['-t'])
+        except Exception:
+            exit("Invalid timeframe passed.")
+
+        if arguments['-y'] is None:
+            years = None
+        elif not bool(re.search(r'(^[0-9]{4}$|^[0-9]{4}:[0-9]{4}$)', arguments['-y'])):
+            exit("Invalid year format.")
+        else:
+            years = [int(x) for x in arguments['-y'].split(":")]
+            years = range(min(years), max(years) + 1)
+
+        if arguments['--format'] not in OUTPUT_FORMATS:
+            exit("Invalid output format. Options are: " + ", ".join(OUTPUT_FORMATS))
+
+        try:
+            workers = int(arguments['--workers'])
+            max_rps = float(arguments['--max-rps'])
+            retries = int(arguments['--retries'])
+            parsers = int(arguments['--parsers'])
+        except ValueError:
+            exit("The number of workers, retries, parsers or the maximum request rate is not a number. Typo?")
+
+        try:
+            fetched = sync(arguments['--store'], stations=stations, type=timeframe, years=years,
+                           progress=(not arguments['--noprogress']), workers=workers, max_rps=max_rps,
+                           cache=(not arguments['--nocache']), format=arguments['--format'],
+                           retries=retries, parsers=parsers)
+        except ImportError:
+            exit("Writing {} files requires pyarrow.".format(arguments['--format']))
+        print("Downloaded", fetched, "files to", arguments['--store'])
+        exit(0)
+
+    if arguments['batch']:
+
+        try:
+            workers = int(arguments['--workers'])
+            max_rps = float(arguments['--max-rps'])
+            retries = int(arguments['--retries'])
+            parsers = int(arguments['--parsers'])
+            interval = float(arguments['--interval'])
+        except ValueError:
+            exit("The number of workers, retries, parsers, the maximum request rate or the interval is not a " +
+                 "number. Typo?")
+
+        options = dict(progress=(not arguments['--noprogress']), workers=workers, max_rps=max_rps,
+                       cache=(not arguments['--nocache']), retries=retries, parsers=parsers)
+
+        if arguments['--watch'] is not None:
+            if not os.path.isdir(arguments['--watch']):
+                exit("Cannot find the directory " + arguments['--watch'])
+            print("Watching", arguments['--watch'], "for jobs. Press Ctrl+C to stop.")
+            try:
+                watch_jobs(arguments['--watch'], interval, **options)
+            except KeyboardInterrupt:
+                exit(0)
+
+        try:
+            jobs = [read_job(filename) for filename in arguments['<job>']]
+        except Exception as e:
+            exit(str(e))
+        errors = run_jobs(jobs, **options)
+        for job, error in zip(jobs, errors):
+            if error is None:
+                print("Saved data to", job['outfile'])
+            else:
+                print("Failed to save", job['outfile'] + ":", error)
+        exit(1 if any(error is not None for error in errors) else 0)
+
+    if arguments['cache']:
+        cache = Cache()
+        if arguments['stats']:
+            stats = cache.stats()
+            print("Cache directory:", stats['path'])
+            print("Files:", stats['files'], "({} stale)".format(stats['stale']))
+            print("Size: {:.1f} MB of {:.0f} MB".format(stats['size'], stats['max_size']))
+        elif arguments['prune']:
+            print("Removed", cache.prune(), "files from", cache.path)
+        elif arguments['clear']:
+            print("Removed", cache.clear(), "files from", cache.path)
         exit(0)
@@ -0,0 +1,299 @@
+"""
+Tests for ec3 against the local stand-in for the ECCC bulk data endpoint in
+benchmark.py. Run with python -m pytest.
+"""
+
+import os
+import asyncio
+import sys
+import random
+import threading
+import subprocess
+from time import monotonic, sleep
+import pytest
+import benchmark
+import ec3
+from pandas.testing import assert_frame_equal
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+
+class Handler(benchmark.FakeBulkHandler):
+    """FakeBulkHandler that records the files requested from it, and when"""
+
+    requested = []
+    times = []
+    # Stations that do not exist (404), and (station, year) files that always fail (503)
+    missing = set()
+    failing = set()
+    # Seconds to wait before answering each data request
+    delay = 0
+
+    def do_GET(self):
+        query = dict(parse_qsl(urlparse(self.path).query))
+        if "stationID" in query:
+            station, year = int(query["stationID"]), int(query["Year"])
+            Handler.requested.append((station, year, int(query["Month"])))
+            Handler.times.append(monotonic())
+            sleep(self.delay)
+            if station in self.missing:
+                return self.send_error(404)
+            if (station, year) in self.failing:
+                return self.send_error(503)
+        super().do_GET()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    Handler.requested = []
+    Handler.times = []
+    Handler.missing = set()
+    Handler.failing = set()
+    Handler.delay = 0
+    Handler.fault_rate = 0.0
+    # Retry without waiting long between attempts
+    monkeypatch.setattr(ec3, "BACKOFF", 0.001)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/climate_data/bulk_data_e.html".format(httpd.server_port)
+    monkeypatch.setattr(ec3, "BULK_URL", url)
+    yield url
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.mark.parametrize("type, years, months", [(2, range(2000, 2006), [6]), (1, [2000], range(1, 7))])
+def test_workers_give_the_same_output(server, type, years, months):
+    kwargs = dict(stations=[5051, 31688], type=type, years=years, months=months, progress=False,
+                  cache=False, max_rps=None)
+    one = ec3.get_data(workers=1, **kwargs)
+    four = ec3.get_data(workers=4, **kwargs)
+    assert one.shape[0] > 0
+    assert_frame_equal(one, four)
+    # Every file is downloaded once, whatever the number of workers
+    assert len(Handler.requested) == 2 * len(kwargs['stations']) * len(years) * len(months)
+    assert len(set(Handler.requested)) == len(Handler.requested) // 2
+
+
+def test_workers_yield_files_in_request_order(server):
+    files = list(ec3.iter_data(stations=[5051, 31688], type=2, years=range(2000, 2004), progress=False,
+                               cache=False, max_rps=None, workers=4))
+    assert [(dat.attrs['metadata']['station'], dat['Year'].iloc[0]) for dat in files] == \
+      [(station, year) for station in [5051, 31688] for year in range(2000, 2004)]
+
+
+def test_retries_recover_from_faults(server):
+    kwargs = dict(stations=[5051, 31688], type=2, years=range(2000, 2010), progress=False, cache=False,
+                  max_rps=None, workers=4)
+    random.seed(14)
+    Handler.fault_rate = 0.3
+    ec3.METRICS.clear()
+    faulty = ec3.get_data(retries=20, **kwargs)
+    assert ec3.METRICS.counters.get('retries', 0) > 0
+    assert len(Handler.requested) > 2 * 10
+    Handler.fault_rate = 0.0
+    assert_frame_equal(faulty, ec3.get_data(**kwargs))
+
+
+def test_retries_respect_the_rate_limit(server):
+    random.seed(14)
+    Handler.fault_rate = 0.5
+    ec3.METRICS.clear()
+    ec3.get_data(stations=[5051, 31688], type=2, years=range(2000, 2006), progress=False, cache=False,
+                 max_rps=20, workers=8, retries=20)
+    assert ec3.METRICS.counters.get('retries', 0) > 0
+    # With a burst of one token, the nth request can start no sooner than (n - 1) / rate seconds in
+    times = sorted(Handler.times)
+    assert len(times) > 2 * 6
+    for n, t in enumerate(times):
+        assert t - times[0] >= n / 20 - 0.05
+
+
+def test_client_errors_fail_immediately(server):
+    Handler.missing = {1}
+    with pytest.raises(Exception, match="404") as error:
+        ec3.get_data(stations=1, type=2, years=2000, progress=False, cache=False, retries=5)
+    assert not isinstance(error.value, ec3.DownloadError)
+    assert Handler.requested == [(1, 2000, 6)]
+
+
+def test_server_errors_are_retried_then_fail(server):
+    Handler.failing = {(5051, 2000)}
+    with pytest.raises(ec3.DownloadError):
+        ec3.get_data(stations=5051, type=2, years=2000, progress=False, cache=False, retries=3)
+    assert Handler.requested == [(5051, 2000, 6)] * 4
+
+
+def test_resume_skips_downloaded_files(server, tmp_path):
+    env = dict(os.environ, EC3_BULK_URL=server, EC3_CACHE_DIR=str(tmp_path / "cache"))
+    command = [sys.executable, os.path.abspath(ec3.__file__), "get", "-s", "5051", "-y", "2000:2004",
+               "--nocache", "--noprogress", "--retries", "0"]
+    checkpoint = tmp_path / "5051-daily-2000-2004.csv.partial"
+
+    Handler.failing = {(5051, 2003)}
+    first = subprocess.run(command, cwd=tmp_path, env=env, capture_output=True, text=True)
+    assert first.returncode != 0
+    assert "--resume" in first.stderr
+    kept = {ec3.parse_bulk_filename(name)[2] for name in os.listdir(checkpoint / "5051")}
+    assert {2000, 2001, 2002} <= kept
+    assert 2003 not in kept
+
+    Handler.failing = set()
+    Handler.requested = []
+    second = subprocess.run(command + ["--resume"], cwd=tmp_path, env=env, capture_output=True, text=True)
+    assert second.returncode == 0, second.stderr
+    assert {year for station, year, month in Handler.requested} == set(range(2000, 2005)) - kept
+    assert not checkpoint.exists()
+    dat = ec3.pd.read_csv(tmp_path / "5051-daily-2000-2004.csv")
+    assert sorted(dat.Year.unique()) == list(range(2000, 2005))
+
+
+@pytest.fixture
+def inventory(tmp_path, monkeypatch):
+    # Station 1 closed in 2010; station 2 is still reporting, as of the 2021 inventory
+    rows = [benchmark.INVENTORY_HEADER]
+    for station, first, last in [(1, 1990, 2010), (2, 2000, 2021)]:
+        rows.append('"STATION {0}","ONTARIO","{0:07d}","{0}","","","43.6","-79.4","","","100.0","{1}","{2}",'
+                    '"{1}","{2}","{1}","{2}","{1}","{2}"\n'.format(station, first, last))
+    (tmp_path / ec3.INVENTORY_FILE).write_text("".join(rows), encoding="utf-8")
+    monkeypatch.chdir(tmp_path)
+    ec3.clear_inventory()
+    yield tmp_path
+    ec3.clear_inventory()
+
+
+def test_plan_keeps_open_records_and_reports_empty_requests(inventory):
+    fetches, plans = ec3.plan_requests([{'stations': [1, 2], 'years': range(2009, 2013)},
+                                        {'stations': 1, 'years': range(2016, 2018)}])
+    assert fetches[2] == [(1, 2009, 6), (1, 2010, 6)] + [(2, year, 6) for year in range(2009, 2013)]
+    assert plans[0][2] is None
+    assert plans[1][1] == []
+    assert str(plans[1][2]) == "There is no data in the inventory record of station(s) 1 for 2016:2017."
+
+
+def test_jobs_without_data_fail(server, inventory):
+    jobs = [dict(stations=[2], type=2, years=range(2020, 2023), outfile=str(inventory / "open.csv"), format="csv"),
+            dict(stations=[1], type=1, years=range(2016, 2018), outfile=str(inventory / "closed"),
+                 format="parquet")]
+    errors = ec3.run_jobs(jobs, progress=False, cache=False, max_rps=None)
+    assert errors[0] is None
+    assert "no data in the inventory record of station(s) 1" in str(errors[1])
+    assert sorted(ec3.pd.read_csv(inventory / "open.csv").Year.unique()) == [2020, 2021, 2022]
+    assert not (inventory / "closed").exists()
+
+
+def test_chain_fills_the_year_of_a_recode(server, inventory, monkeypatch):
+    fake_bulk_data = benchmark.fake_bulk_data
+
+    def closing(station, year, month, type):
+        # Station 1 closes on 2010-07-01, but its file still runs to the end of the year
+        lines = fake_bulk_data(station, year, month, type).splitlines(keepends=True)
+        for i, line in enumerate(lines):
+            fields = line.rstrip("\n").split(",")
+            if station == "1" and "2010-07-01" <= fields[0].strip('"') <= "2010-12-31":
+                lines[i] = ",".join(fields[:5] + ['""'] * (len(fields) - 5)) + "\n"
+        return "".join(lines)
+
+    monkeypatch.setattr(benchmark, "fake_bulk_data", closing)
+    dat = ec3.get_chain(stations=[1, 2], type=2, years=range(2009, 2012), progress=False, cache=False)
+    assert sorted(set(Handler.requested)) == [(1, 2009, 6), (1, 2010, 6), (2, 2010, 6), (2, 2011, 6)]
+    assert dat["Date/Time"].is_unique
+    assert dat["Date/Time"].is_monotonic_increasing
+    source = dat.set_index("Date/Time").Station
+    assert (source["2009-01-01":"2010-06-30"] == 1).all()
+    assert (source["2010-07-01":] == 2).all()
+    assert dat["Max Temp (°C)"].notnull().all()
+
+
+def test_sync_skips_complete_stations_until_a_file_is_deleted(server, inventory, monkeypatch):
+    store = str(inventory / "store")
+    kwargs = dict(stations=[1], years=range(2008, 2011), progress=False, cache=False)
+    assert ec3.sync(store, **kwargs) == 3
+    checked = []
+    store_filename = ec3.store_filename
+    monkeypatch.setattr(ec3, "store_filename", lambda *args: checked.append(args) or store_filename(*args))
+    assert ec3.sync(store, **kwargs) == 0
+    assert checked == []
+    os.remove(store_filename(store, 2, 1, 2009, 6, "csv"))
+    Handler.requested = []
+    assert ec3.sync(store, **kwargs) == 1
+    assert Handler.requested == [(1, 2009, 6)]
+    assert ec3.sync(store, **kwargs) == 0
+
+
+def test_provinces_missing_from_the_inventory_match_nothing(inventory):
+    index = ec3.get_inventory_index("session")
+    assert index.province_mask("ON").all()
+    assert not index.province_mask(["AB", "YT"]).any()
+
+
+def test_files_evicted_during_a_lookup_are_misses(server, tmp_path, monkeypatch):
+    cache = ec3.Cache(path=str(tmp_path / "cache"))
+    kwargs = dict(stations=5051, type=2, years=[2000, 2001], progress=False, max_rps=None)
+    expected = ec3.get_data(cache=cache, **kwargs)
+
+    # Another process clears the cache between the lookup and the read
+    get = ec3.Cache.get
+    def evicted(self, *args):
+        filename = get(self, *args)
+        if filename is not None:
+            os.remove(filename)
+        return filename
+    monkeypatch.setattr(ec3.Cache, "get", evicted)
+    Handler.requested = []
+    assert_frame_equal(ec3.get_data(cache=cache, **kwargs), expected)
+    assert len(Handler.requested) == 2
+
+    # ...or between the stat and the utime
+    monkeypatch.setattr(ec3.Cache, "get", get)
+    def utime(filename, times):
+        os.remove(filename)
+        raise FileNotFoundError(filename)
+    monkeypatch.setattr(ec3.os, "utime", utime)
+    assert cache.get(5051, 2, 2000, 6) is None
+
+
+def test_async_workers_give_the_same_output(server):
+    pytest.importorskip("aiohttp")
+    kwargs = dict(stations=[5051, 31688], type=2, years=range(2000, 2006), cache=False, max_rps=None)
+    expected = ec3.get_data(progress=False, **kwargs)
+    assert_frame_equal(asyncio.run(ec3.aget_data(workers=4, **kwargs)), expected)
+
+
+def test_leaving_aiter_data_early_cancels_downloads(server, monkeypatch):
+    pytest.importorskip("aiohttp")
+    Handler.delay = 0.2
+    sessions = []
+    cancelled = []
+    make_async_session = ec3.make_async_session
+    afetch_text = ec3.afetch_text
+
+    def recording_session(*args, **kwargs):
+        sessions.append(make_async_session(*args, **kwargs))
+        return sessions[-1]
+
+    async def recording_fetch(*args, **kwargs):
+        try:
+            return await afetch_text(*args, **kwargs)
+        except asyncio.CancelledError:
+            cancelled.append(args[0])
+            raise
+
+    monkeypatch.setattr(ec3, "make_async_session", recording_session)
+    monkeypatch.setattr(ec3, "afetch_text", recording_fetch)
+
+    async def first_file():
+        files = ec3.aiter_data(stations=5051, type=2, years=range(2000, 2020), workers=2, cache=False,
+                               max_rps=None)
+        dat = await files.__anext__()
+        await files.aclose()
+        return dat
+
+    dat = asyncio.run(first_file())
+    assert dat['Year'].iloc[0] == 2000
+    assert len(sessions) == 1 and sessions[0].closed
+    assert len(cancelled) > 0
+    # Nothing is downloaded after the caller has left
+    requested = len(Handler.requested)
+    sleep(0.5)
+    assert len(Handler.requested) == requested < 20